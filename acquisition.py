@@ -0,0 +1,105 @@
+# This module contains the background acquisition worker used by power-monitor.py.
+# The worker keeps sampling while the main thread is busy with the power calculations and the database writes,
+# so there is (almost) no gap between one capture window and the next.
+
+import threading
+from time import perf_counter
+from queue import Queue, Empty, Full
+from config import logger
+from common import collect_data, collect_sums, collect_cycles
+from buffers import SampleBuffer
+from dsp import channel_names
+
+
+class AcquisitionWorker(threading.Thread):
+    '''
+    Collects sample windows in the background and hands them to the processing thread through a bounded queue.
+    num_samples     : number of samples per window
+    reference       : BoardReference (see reference.py) that gives the board voltage of every window, so that the
+                      processing stage never has to touch the SPI bus
+    queue_depth     : the number of completed windows that can wait for processing. If processing falls further
+                      behind than this, the oldest waiting window is dropped and counted as an overrun.
+    streaming       : capture with collect_sums() instead of collect_data()
+    aligned         : capture with collect_cycles() instead of collect_data(), so every window holds whole mains cycles
+    scheduler       : optional AdaptiveScheduler (see scheduler.py) that chooses the CTs to sample in each window
+    perf            : optional PerfMonitor (see perf.py) that the capture time of each window is recorded in, as the 'acquisition' stage
+
+    windows         : total number of windows captured
+    overruns        : number of windows that were dropped because processing could not keep up
+
+    When capturing raw samples, the windows are written into a fixed pool of SampleBuffers: one being filled, one for
+    every queue slot, and one being processed. The window returned by get() stays valid until the next call to get()
+    (or release()), after which its buffer is reused.
+    '''
+    def __init__(self, num_samples, reference, queue_depth=2, streaming=False, scheduler=None, perf=None, aligned=False):
+        super().__init__(name='acquisition', daemon=True)
+        self.num_samples = num_samples
+        self.reference = reference
+        self.streaming = streaming
+        self.aligned = aligned
+        self.scheduler = scheduler
+        self.perf = perf
+        self.windows = 0
+        self.overruns = 0
+        self._queue = Queue(maxsize=queue_depth)
+        self._stop_event = threading.Event()
+        self._in_use = None
+
+        self._free = Queue()
+        if not streaming:
+            # collect_cycles() needs room to carry on sampling past num_samples
+            capacity = num_samples * 3 // 2 if aligned else num_samples
+            for _ in range(queue_depth + 2):
+                self._free.put(SampleBuffer(channel_names, capacity))
+
+    def run(self):
+        while not self._stop_event.is_set():
+            reference = self.reference.due()
+            start = perf_counter()
+            if self.scheduler:
+                samples = self.scheduler.collect(self.num_samples, None if self.streaming else self._free.get(), self.streaming, self.aligned, reference)
+            elif self.streaming:
+                samples = collect_sums(self.num_samples, reference=reference)
+            elif self.aligned:
+                samples = collect_cycles(self.num_samples, self._free.get(), reference=reference)
+            else:
+                samples = collect_data(self.num_samples, self._free.get(), reference=reference)
+            if self.perf:
+                self.perf.record('acquisition', perf_counter() - start)
+            samples['board_voltage'] = self.reference.update(samples)
+            self.windows += 1
+            self._put(samples)
+
+    def _put(self, samples):
+        while True:
+            try:
+                self._queue.put_nowait(samples)
+                return
+            except Full:
+                # Processing is behind - drop the oldest waiting window so that the newest data always gets through.
+                try:
+                    dropped = self._queue.get_nowait()
+                    self._recycle(dropped)
+                    self.overruns += 1
+                    logger.debug(f"Acquisition overrun: dropped a sample window ({self.overruns} total)")
+                except Empty:
+                    pass
+
+    def _recycle(self, samples):
+        if 'buffer' in samples:
+            self._free.put(samples['buffer'])
+
+    def get(self, timeout=None):
+        # Returns the next completed sample window. Blocks until one is available.
+        self.release()
+        self._in_use = self._queue.get(timeout=timeout)
+        return self._in_use
+
+    def release(self):
+        # Hands the buffer of the window returned by the last get() back to the acquisition thread.
+        if self._in_use is not None:
+            self._recycle(self._in_use)
+            self._in_use = None
+
+    def stop(self):
+        self._stop_event.set()
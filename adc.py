@@ -0,0 +1,194 @@
+# This module contains the ADC backends that common.py reads the MCP3008 chips through.
+# 'spidev' talks to the chips on the board. 'simulated' generates the readings in software, so the program can be
+# imported, tested and benchmarked on any Linux machine. The backend is chosen by adc_settings['backend'] in config.py,
+# or by the POWER_MONITOR_ADC environment variable.
+#
+# Every backend provides:
+#   scan(chip, adc_channels)    : returns an object whose read() method samples the given ADC channels of one chip, in order,
+#                                 and returns a list of 10-bit values (see ChannelScan)
+#   read(chip, adcnum)          : returns a single 10-bit reading
+#   clock()                     : returns the time in seconds on the ADC's clock, for measuring sample rates
+
+import os
+import ctypes
+import fcntl
+import random
+from math import sin, pi, radians
+from time import perf_counter
+from config import adc_chips, adc_settings, channels, logger
+
+
+# struct spi_ioc_transfer from linux/spi/spidev.h. Submitting an array of these in a single SPI_IOC_MESSAGE ioctl
+# lets us read several channels with one call into the kernel, while still releasing CS between each MCP3008 frame.
+# (The MCP3008 only starts a new conversion on the falling edge of CS, so the frames can't just be concatenated into one xfer2.)
+class spi_ioc_transfer(ctypes.Structure):
+    _fields_ = [
+        ('tx_buf', ctypes.c_uint64),
+        ('rx_buf', ctypes.c_uint64),
+        ('len', ctypes.c_uint32),
+        ('speed_hz', ctypes.c_uint32),
+        ('delay_usecs', ctypes.c_uint16),
+        ('bits_per_word', ctypes.c_uint8),
+        ('cs_change', ctypes.c_uint8),
+        ('tx_nbits', ctypes.c_uint8),
+        ('rx_nbits', ctypes.c_uint8),
+        ('word_delay_usecs', ctypes.c_uint8),
+        ('pad', ctypes.c_uint8),
+    ]
+
+def SPI_IOC_MESSAGE(n):
+    # Equivalent of the _IOW(SPI_IOC_MAGIC, 0, char[SPI_MSGSIZE(n)]) macro.
+    return (1 << 30) | ((n * ctypes.sizeof(spi_ioc_transfer)) << 16) | (ord('k') << 8)
+
+def decode_frames(rx):
+    # Each 3 byte MCP3008 reply holds the top 2 bits of the result in byte 1 and the low 8 bits in byte 2.
+    return [((hi & 3) << 8) + lo for hi, lo in zip(rx[1::3], rx[2::3])]
+
+class ChannelScan():
+    '''
+    Reads a fixed list of channels from one MCP3008 in a single ioctl.
+    spi         : an open spidev.SpiDev for the chip
+    channels    : list of ADC channel numbers, in the order they should be sampled
+    read()      : returns a list of 10-bit values, one per entry in channels
+    '''
+    def __init__(self, spi, channels):
+        self.channels = list(channels)
+        num_frames = len(self.channels)
+
+        # The tx/rx buffers and the transfer array are built once and reused for every read.
+        self.tx = bytearray(3 * num_frames)
+        self.rx = bytearray(3 * num_frames)
+        for i, adcnum in enumerate(self.channels):
+            self.tx[3 * i] = 1
+            self.tx[3 * i + 1] = 8 + adcnum << 4
+
+        tx_addr = ctypes.addressof((ctypes.c_char * len(self.tx)).from_buffer(self.tx))
+        rx_addr = ctypes.addressof((ctypes.c_char * len(self.rx)).from_buffer(self.rx))
+        self.transfers = (spi_ioc_transfer * num_frames)()
+        for i, transfer in enumerate(self.transfers):
+            transfer.tx_buf = tx_addr + 3 * i
+            transfer.rx_buf = rx_addr + 3 * i
+            transfer.len = 3
+            transfer.speed_hz = spi.max_speed_hz
+            transfer.bits_per_word = 8
+            # Toggle CS after every frame except the last one (cs_change on the last frame would leave CS asserted).
+            transfer.cs_change = 1 if i < num_frames - 1 else 0
+
+        self.fd = spi.fileno()
+        self.request = SPI_IOC_MESSAGE(num_frames)
+
+    def read(self):
+        fcntl.ioctl(self.fd, self.request, self.transfers)
+        return decode_frames(self.rx)
+
+
+class SpiBackend():
+    '''
+    Reads the MCP3008 chips on the board through /dev/spidev<bus>.<device>.
+    chips       : the adc_chips dictionary from config.py
+    speed_hz    : SPI clock speed
+    '''
+    def __init__(self, chips, speed_hz=1750000):
+        # Only imported here, so that the simulated backend works on machines without spidev.
+        import spidev
+        self.devices = {}
+        for chip, settings in chips.items():
+            spi = spidev.SpiDev()
+            spi.open(settings['bus'], settings['device'])
+            spi.max_speed_hz = speed_hz
+            self.devices[chip] = spi
+
+    def scan(self, chip, adc_channels):
+        return ChannelScan(self.devices[chip], adc_channels)
+
+    def clock(self):
+        return perf_counter()
+
+    def read(self, chip, adcnum):
+        # read SPI data from one channel of an MCP3008, 8 channels in total
+        r = self.devices[chip].xfer2([1, 8 + adcnum << 4, 0])
+        return ((r[1] & 3) << 8) + r[2]
+
+
+class SimulatedScan():
+    # The simulated counterpart of ChannelScan.
+    def __init__(self, adc, chip, adc_channels):
+        self.adc = adc
+        self.channels = list(adc_channels)
+        self.inputs = [(chip, adcnum) for adcnum in self.channels]
+
+    def read(self):
+        convert = self.adc.convert
+        return [convert(chip, adcnum) for chip, adcnum in self.inputs]
+
+
+class SimulatedMCP3008():
+    '''
+    Generates MCP3008 readings in software. Every input is a sine wave at the mains frequency with optional harmonics,
+    a phase shift, gaussian noise and a DC offset, clipped to the 10-bit range of the ADC.
+
+    The simulated clock advances by 1 / conversion_rate on every conversion, no matter how fast the readings are
+    requested, so consecutive channels are offset in time just like they are on the hardware, and a window always
+    covers the same part of the waveform.
+
+    chips       : the adc_chips dictionary from config.py
+    settings    : adc_settings['simulation'] from config.py
+    '''
+    def __init__(self, chips, settings):
+        self.frequency = settings['frequency']
+        self.conversion_rate = settings['conversion_rate']
+        self.random = random.Random(settings.get('seed'))
+        self.conversions = 0
+
+        # Waveform of every (chip, channel) input, looked up by name in the channel table.
+        names = {(channel['chip'], channel['channel']) : name for name, channel in channels.items()}
+        self.waveforms = {}
+        for chip in chips:
+            for adcnum in range(8):
+                name = names.get((chip, adcnum))
+                self.waveforms[(chip, adcnum)] = self._waveform(settings['inputs'].get(name, settings['default']))
+
+    @staticmethod
+    def _waveform(spec):
+        # Returns (offset, noise, [(harmonic, amplitude, phase in radians), ...]) for one input.
+        amplitude = spec.get('amplitude', 0)
+        phase = radians(spec.get('phase', 0))
+        components = [(1, amplitude, phase)] if amplitude else []
+        for harmonic, fraction in spec.get('harmonics', {}).items():
+            components.append((harmonic, amplitude * fraction, harmonic * phase))
+        return spec.get('offset', 512), spec.get('noise', 0), components
+
+    def convert(self, chip, adcnum):
+        offset, noise, components = self.waveforms[(chip, adcnum)]
+        angle = 2 * pi * self.frequency * self.conversions / self.conversion_rate
+        self.conversions += 1
+
+        value = offset
+        for harmonic, amplitude, phase in components:
+            value += amplitude * sin(harmonic * angle + phase)
+        if noise:
+            value += self.random.gauss(0, noise)
+        return min(1023, max(0, int(round(value))))
+
+    def scan(self, chip, adc_channels):
+        return SimulatedScan(self, chip, adc_channels)
+
+    def read(self, chip, adcnum):
+        return self.convert(chip, adcnum)
+
+    def clock(self):
+        # Simulated time - see the class docstring.
+        return self.conversions / self.conversion_rate
+
+
+BACKENDS = ('spidev', 'simulated')
+
+def get_backend():
+    # Creates the ADC backend chosen by the POWER_MONITOR_ADC environment variable, or adc_settings['backend'] in config.py.
+    name = os.environ.get('POWER_MONITOR_ADC') or adc_settings['backend']
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown ADC backend '{name}'. Choose from: {', '.join(BACKENDS)}")
+    if name == 'simulated':
+        logger.info("Using the simulated ADC - the readings are generated in software.")
+        return SimulatedMCP3008(adc_chips, adc_settings['simulation'])
+    return SpiBackend(adc_chips, adc_settings['spi_speed_hz'])
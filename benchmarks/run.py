@@ -0,0 +1,148 @@
+# Benchmark suite for the acquisition and DSP hot paths. Every benchmark runs against the simulated ADC (see adc.py),
+# over a matrix of window sizes (samples per channel) and channel counts (number of CTs), and the results are written
+# as JSON. Given a baseline from an earlier run, the suite exits with status 1 if any benchmark got slower than the
+# baseline by more than the threshold.
+#
+#   collect_data     : capturing one window from the simulated ADC
+#   rebuild_waves    : the phase correction in power-monitor.py
+#   calculate_power  : the power calculations in power-monitor.py
+#   calculate_window : rebuild_waves() + calculate_power() with the configured DSP engine (dsp_engine in config.py)
+#   check_phasecal   : the single CT calculation used by phase mode (window size only)
+#   point_to_dict    : Point.to_dict() for one write_to_influx() batch (channel count only)
+#   write_to_influx  : serializing one write_to_influx() batch to line protocol (channel count only - it always writes every CT)
+#
+# Usage (from the project root):
+#   python3 benchmarks/run.py [--windows 500,2000,8000] [--channels 1,5,13] [--output results.json]
+#                             [--baseline baseline.json] [--threshold 10]
+
+import os
+import sys
+import json
+import argparse
+import platform
+import importlib.util
+import timeit
+from datetime import datetime
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['POWER_MONITOR_ADC'] = 'simulated'
+
+import influx_interface as infl
+from common import build_scans, collect_data
+from calibration import rebuild_wave, check_phasecal
+from dsp import ct_names
+from influx_interface import Point
+
+# power-monitor.py can't be imported by name because of the dash.
+spec = importlib.util.spec_from_file_location('power_monitor', os.path.join(ROOT, 'power-monitor.py'))
+power_monitor = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(power_monitor)
+
+BOARD_VOLTAGE = 3.3
+
+
+def measure(func, repeat, min_time=0.2):
+    # Returns the per-call timings (in microseconds) of func over repeat rounds. Each round makes enough calls to take about min_time seconds.
+    number = max(1, int(min_time / max(timeit.timeit(func, number=1), 1e-9)))
+    return [t / number * 1e6 for t in timeit.repeat(func, number=number, repeat=repeat)]
+
+
+def capture(window, channels):
+    # Returns a window of samples from the simulated ADC for the first `channels` CTs.
+    return collect_data(window, scan_list=build_scans(ct_names[:channels] + ['voltage']))
+
+
+def benchmarks(windows, channel_counts):
+    # Yields (name, parameters, callable) for every benchmark in the matrix.
+    for window in windows:
+        for channels in channel_counts:
+            scan_list = build_scans(ct_names[:channels] + ['voltage'])
+            samples = capture(window, channels)
+            rebuilt = power_monitor.rebuild_waves(samples, power_monitor.ct_phasecals)
+            params = {'window' : window, 'channels' : channels}
+            yield 'collect_data', params, lambda window=window, scan_list=scan_list: collect_data(window, scan_list=scan_list)
+            yield 'rebuild_waves', params, lambda samples=samples: power_monitor.rebuild_waves(samples, power_monitor.ct_phasecals)
+            yield 'calculate_power', params, lambda rebuilt=rebuilt: power_monitor.calculate_power(rebuilt, BOARD_VOLTAGE)
+            yield 'calculate_window', params, lambda samples=samples: power_monitor.calculate_window(samples, BOARD_VOLTAGE)
+
+        samples = capture(window, 1)
+        wave = rebuild_wave(samples[ct_names[0]], samples['voltage'], 1.0)
+        yield 'check_phasecal', {'window' : window}, lambda wave=wave: check_phasecal(wave['ct'], wave['new_v'], BOARD_VOLTAGE)
+
+    poll_time = datetime.utcnow()
+    for channels in channel_counts:
+        names = ct_names[:channels]
+        yield 'point_to_dict', {'channels' : channels}, lambda names=names: [
+            Point('ct', power=100.5, current=1.25, pf=0.98, time=poll_time, num=name[2:]).to_dict() for name in names]
+
+    aggregate = dict(power=[1520.25, 1519.75], current=[12.75, 12.5], pf=[0.98, 0.97])
+    ct_values = {name : dict(power=[100.5, 101.5], current=[1.25, 1.5], pf=[0.98, 0.99]) for name in ct_names}
+    yield 'write_to_influx', {'channels' : len(ct_names)}, lambda: infl.write_to_influx(aggregate, aggregate, aggregate, ct_values, poll_time, 2, [121.5, 121.75])
+
+
+def key(name, params):
+    return '/'.join([name] + [f'{k}={v}' for k, v in params.items()])
+
+
+def run(windows, channel_counts, repeat):
+    # Returns the results dictionary that is written as JSON.
+    # write_to_influx() is only timed up to the point where the batch is handed to the writer.
+    infl.write_points = lambda points, retention_policy=None: None
+
+    results = {}
+    for name, params, func in benchmarks(windows, channel_counts):
+        timings = measure(func, repeat)
+        results[key(name, params)] = dict(params, name=name, min_us=min(timings), median_us=median(timings))
+        print(f"{key(name, params):<50} {min(timings):12.1f} us", file=sys.stderr)
+
+    return {
+        'time' : datetime.utcnow().isoformat(),
+        'python' : platform.python_version(),
+        'machine' : platform.machine(),
+        'dsp_engine' : power_monitor.DSP_ENGINE,
+        'results' : results,
+    }
+
+
+def regressions(results, baseline, threshold):
+    # Returns a list of (key, baseline_us, current_us) for the benchmarks that are more than threshold percent slower than the baseline.
+    slower = []
+    for k, result in results['results'].items():
+        if k in baseline['results']:
+            before = baseline['results'][k]['min_us']
+            if result['min_us'] > before * (1 + threshold / 100):
+                slower.append((k, before, result['min_us']))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the acquisition and DSP hot paths.')
+    parser.add_argument('--windows', default='500,2000,8000', help='comma separated window sizes (samples per channel)')
+    parser.add_argument('--channels', default=f'1,5,{len(ct_names)}', help='comma separated CT counts')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing rounds per benchmark')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed slowdown against the baseline, in percent')
+    args = parser.parse_args()
+
+    windows = [int(n) for n in args.windows.split(',')]
+    channel_counts = [min(int(n), len(ct_names)) for n in args.channels.split(',')]
+    results = run(windows, channel_counts, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.threshold)
+        for k, before, after in slower:
+            print(f"REGRESSION {k}: {before:.1f} us -> {after:.1f} us (+{(after / before - 1) * 100:.0f}%)", file=sys.stderr)
+        if slower:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold}% against {args.baseline}.", file=sys.stderr)
@@ -0,0 +1,62 @@
+# Microbenchmark comparing the cost of serializing one write_to_influx() batch (a point per enabled CT, plus home_load, solar, net and voltage) with:
+#   dict : Point(...).to_dict() for every point, then influxdb's make_lines() (what write_points() does with protocol='json')
+#   line : the precomputed LinePoint templates used by write_to_influx()
+#
+# Usage (from the project root):    python3 benchmarks/serialization.py [batches]
+
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from influxdb.line_protocol import make_lines
+from influx_interface import Point, HOME_LOAD_POINT, SOLAR_POINT, NET_POINTS, CT_POINTS, VOLTAGE_POINT, to_ms
+from dsp import ct_names
+
+
+def dict_batch(poll_time, cts, voltage):
+    points = [
+        Point('home_load', power=1520.25, current=12.75, time=poll_time).to_dict(),
+        Point('solar', power=0, current=0, pf=0, time=poll_time).to_dict(),
+        Point('net', power=1520.25, current=12.75, time=poll_time).to_dict(),
+    ]
+    for name, (power, current, pf) in zip(ct_names, cts):
+        points.append(Point('ct', power=power, current=current, pf=pf, time=poll_time, num=name[2:]).to_dict())
+    points.append(Point('voltage', voltage=voltage, v_input=0, time=poll_time).to_dict())
+    return make_lines({'points' : points}, 'ms')
+
+
+def line_batch(poll_time, cts, voltage):
+    timestamp = to_ms(poll_time)
+    points = [
+        HOME_LOAD_POINT.line((12.75, 1520.25), timestamp),
+        SOLAR_POINT.line((0, 0, 0), timestamp),
+        NET_POINTS['Consuming'].line((12.75, 1520.25), timestamp),
+    ]
+    for name, (power, current, pf) in zip(ct_names, cts):
+        points.append(CT_POINTS[name].line((current, power, pf), timestamp))
+    points.append(VOLTAGE_POINT.line((voltage,), timestamp))
+    return ('\n'.join(points) + '\n').encode('utf-8')
+
+
+def run(batches=5000):
+    poll_time = datetime.utcnow()
+    cts = [(100.0 + num * 10.123456, 1.0 + num * 0.0987654, 0.97 + num * 0.001) for num in range(len(ct_names))]
+    voltage = 121.456789
+
+    results = {}
+    for name, func in (('dict', dict_batch), ('line', line_batch)):
+        duration = min(timeit.repeat(lambda: func(poll_time, cts, voltage), number=batches, repeat=3))
+        results[name] = duration / batches * 1e6     # microseconds per batch
+    return results
+
+
+if __name__ == '__main__':
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    results = run(batches)
+    num_points = line_batch(datetime.utcnow(), [(0, 0, 0)] * len(ct_names), 0).count(b'\n')
+    for name, usec in results.items():
+        print(f"{name:>5}: {usec:8.1f} us per {num_points}-point batch")
+    print(f"speedup: {results['dict'] / results['line']:.1f}x")
@@ -0,0 +1,58 @@
+# This module contains the preallocated sample buffer that collect_data() writes raw ADC readings into.
+
+from array import array
+
+
+class SampleBuffer():
+    '''
+    Holds one capture window of raw 10-bit ADC readings in a single contiguous array of unsigned shorts, laid out
+    channel-major: channel k occupies data[k * num_samples : (k + 1) * num_samples]. The buffer is meant to be reused
+    for every capture window, so no new objects are created per sample.
+
+    channels    : list of channel names, e.g. ['ct0', 'ct1', ... 'voltage']
+    num_samples : number of samples per channel
+    time        : timestamp of the capture currently held in the buffer
+    memory      : optional existing memory (any writable bytes-like object) to lay the buffer over instead of allocating
+                  a new array, e.g. a slot of a multiprocessing.shared_memory block (see pipeline.py)
+
+    channel(name) returns a memoryview over a single channel (no copy). as_samples() returns the dictionary format
+    collect_data() has always returned, with memoryviews in place of lists.
+    '''
+    def __init__(self, channels, num_samples, memory=None):
+        self.channels = list(channels)
+        self.num_samples = num_samples
+        self.time = None
+        if memory is None:
+            self.data = array('H', bytes(2 * len(self.channels) * num_samples))
+        else:
+            self.data = memoryview(memory).cast('B').cast('H')[:len(self.channels) * num_samples]
+        self._setup_views()
+
+    def _setup_views(self):
+        self.view = memoryview(self.data)
+        self.views = {}
+        for k, name in enumerate(self.channels):
+            start = k * self.num_samples
+            self.views[name] = self.view[start:start + self.num_samples]
+
+    def channel(self, name):
+        return self.views[name]
+
+    def as_samples(self):
+        samples = dict(self.views)
+        samples['time'] = self.time
+        samples['buffer'] = self
+        return samples
+
+    # memoryviews can't be pickled, so only the array and the layout are stored. The views are rebuilt on load.
+    # A buffer over shared memory is copied into a plain array.
+    def __getstate__(self):
+        data = self.data if isinstance(self.data, array) else array('H', self.data.tobytes())
+        return {'channels' : self.channels, 'num_samples' : self.num_samples, 'time' : self.time, 'data' : data}
+
+    def __setstate__(self, state):
+        self.channels = state['channels']
+        self.num_samples = state['num_samples']
+        self.time = state['time']
+        self.data = state['data']
+        self._setup_views()
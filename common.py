@@ -1,112 +1,274 @@
 # This module contains functions that are used in both the main power-monitor code and the calibration code.
 
 from datetime import datetime
-from config import ct_phase_correction, ct0_channel, ct1_channel, ct2_channel, ct3_channel, ct4_channel, board_voltage_channel, v_sensor_channel, ct6_channel, ct7_channel, ct8_channel, ct9_channel, ct10_channel, ct11_channel, ct12_channel, ct13_channel, logger
-import spidev
+from config import adc_chips, channels, logger
+from adc import get_backend
 import subprocess
 import docker
-import sys
-from time import sleep
+from time import sleep, perf_counter
+from dsp import channel_names, accumulate_sums, merge_sums
+from buffers import SampleBuffer
+from array import array
 from textwrap import dedent
 
-#Create SPI on Chip 1
-spi_ce0 = spidev.SpiDev()
-spi_ce0.open(0, 0)
-spi_ce0.max_speed_hz = 1750000          # Changing this value will require you to adjust the phasecal values above.
-
-#Create SPI on Chip 2
-spi_ce1 = spidev.SpiDev()
-spi_ce1.open(0, 1)
-spi_ce1.max_speed_hz = 1750000          # Changing this value will require you to adjust the phasecal values above.
-
-def readadc_ce0(adcnum):
-    # read SPI data from the first MCP3008, 8 channels in total
-    r = spi_ce0.xfer2([1, 8 + adcnum << 4, 0])
-    data = ((r[1] & 3) << 8) + r[2]
-    return data
-
-def readadc_ce1(adcnum):
-    # read SPI data from the second MCP3008, 8 channels in total
-    r = spi_ce1.xfer2([1, 8 + adcnum << 4, 0])
-    data = ((r[1] & 3) << 8) + r[2]
-    return data
-
-def collect_data(numSamples):
+# The ADC backend - the MCP3008 chips on the board, or the simulated ADC (see adc.py)
+adc = get_backend()
+
+def readadc(chip, adcnum):
+    # read one channel of an MCP3008, 8 channels in total
+    return adc.read(chip, adcnum)
+
+def build_scans(names):
+    '''
+    Builds one scan (see adc.py) per chip for the given channel names (keys of the channel table in config.py).
+    Returns a list of (scan, names) tuples, where names are the channels returned by scan.read(), in order.
+    The channels of each chip are sampled in channel table order - changing the order will require you to redo the phase calibration.
+    '''
+    scans = []
+    for chip in adc_chips:
+        chip_names = [name for name in channels if name in names and channels[name]['chip'] == chip]
+        if chip_names:
+            scans.append((adc.scan(chip, [channels[name]['channel'] for name in chip_names]), chip_names))
+    return scans
+
+# Scans for every enabled CT and the voltage channel
+scans = build_scans(channel_names)
+
+# 11 back to back readings of the +3.3V rail, used by get_board_voltage()
+board_voltage_input = channels['board_voltage']
+scan_board_voltage = adc.scan(board_voltage_input['chip'], [board_voltage_input['channel']] * 11)
+
+# Scan lists with the board_voltage channel added, keyed by the channels of the original scan list
+_reference_scans = {}
+
+def with_reference(scan_list):
+    '''
+    Returns a version of scan_list (see build_scans()) that also reads the board_voltage channel at the end of every pass.
+    The channel is added to the last scan when that scan is on the same chip (so it costs one more frame in the same
+    ioctl), or gets a scan of its own otherwise. Either way, the time offsets between the other channels in a pass -
+    which the phase calibration depends on - don't change.
+    '''
+    key = tuple(tuple(names) for scan, names in scan_list)
+    if key not in _reference_scans:
+        last_scan, last_names = scan_list[-1]
+        chip = board_voltage_input['chip']
+        if channels[last_names[0]]['chip'] == chip:
+            adc_channels = [channels[name]['channel'] for name in last_names] + [board_voltage_input['channel']]
+            _reference_scans[key] = scan_list[:-1] + [(adc.scan(chip, adc_channels), last_names + ['board_voltage'])]
+        else:
+            _reference_scans[key] = scan_list + [(adc.scan(chip, [board_voltage_input['channel']]), ['board_voltage'])]
+    return _reference_scans[key]
+
+def measure_scan_rate(scan_list, passes=1000):
+    # Returns how many complete passes over scan_list (see build_scans()) can be made per second - i.e. the sample rate of each channel.
+    start = perf_counter()
+    for _ in range(passes):
+        for scan, names in scan_list:
+            scan.read()
+    return passes / (perf_counter() - start)
+
+def collect_data(numSamples, buffer=None, scan_list=None, reference=False):
+    '''
+    Captures numSamples readings from every channel into a SampleBuffer (see buffers.py).
+    buffer      : a SampleBuffer of at least numSamples per channel to reuse. A new one is allocated if not given.
+    scan_list   : only sample the channels in these scans (see build_scans()) instead of every enabled channel. The other
+                  channels of the buffer are left untouched, and are not included in the returned dictionary.
+    reference   : also sample the board_voltage channel in every pass (see with_reference()), and return its average
+                  reading under the 'reference' key. Used by BoardReference in reference.py.
+    Returns buffer.as_samples() - a dictionary of memoryviews over the buffer, keyed by channel name, plus 'time' and 'buffer'.
+    '''
+    if buffer is None or buffer.num_samples != numSamples:
+        buffer = SampleBuffer(channel_names, numSamples)
+
     # Get time of reading
-    now = datetime.utcnow()
-    
-    samples = []
-    ct0_data = []
-    ct1_data = []
-    ct2_data = []
-    ct3_data = []
-    ct4_data = []
-    ct5_data = []   
-    ct6_data = []
-    ct7_data = []
-    ct8_data = []
-    ct9_data = []
-    ct10_data = []
-    ct11_data = []
-    ct12_data = []
-    ct13_data = []
-    v_data = []
-
-    for _ in range(numSamples):
-        ct0 = readadc_ce0(ct0_channel)
-        ct4 = readadc_ce0(ct4_channel)
-        ct1 = readadc_ce0(ct1_channel)
-        ct2 = readadc_ce0(ct2_channel)
-        ct3 = readadc_ce0(ct3_channel)
-        ct5 = readadc_ce0(ct5_channel)
-        v = readadc_ce0(v_sensor_channel)
-        ct6 = readadc_ce1(ct6_channel)
-        ct7 = readadc_ce1(ct7_channel)
-        ct8 = readadc_ce1(ct8_channel)
-        ct9 = readadc_ce1(ct9_channel)
-        ct10 = readadc_ce1(ct10_channel)
-        ct11 = readadc_ce1(ct11_channel)
-        ct12 = readadc_ce1(ct12_channel)
-        ct13 = readadc_ce1(ct13_channel)
-        
-        ct0_data.append(ct0)
-        ct1_data.append(ct1)
-        ct2_data.append(ct2)
-        ct3_data.append(ct3)
-        ct4_data.append(ct4)
-        ct5_data.append(ct5)
-        v_data.append(v)
-        ct6_data.append(ct6)
-        ct7_data.append(ct7)
-        ct8_data.append(ct8)
-        ct9_data.append(ct9)
-        ct10_data.append(ct10)
-        ct11_data.append(ct11)
-        ct12_data.append(ct12)
-        ct13_data.append(ct13)            
-    
-    samples = {
-        'ct0' : ct0_data,
-        'ct1' : ct1_data,
-        'ct2' : ct2_data,
-        'ct3' : ct3_data,
-        'ct4' : ct4_data,
-        'ct5' : ct5_data,
-        'ct6' : ct6_data,
-        'ct7' : ct7_data,        
-        'ct8' : ct8_data,
-        'ct9' : ct9_data,
-        'ct10' : ct10_data,
-        'ct11' : ct11_data,
-        'ct12' : ct12_data,
-        'ct13' : ct13_data,
-        'voltage' : v_data,
-        'time' : now,
-    }
+    buffer.time = datetime.utcnow()
+
+    views = buffer.views
+    scanned = scan_list or scans
+    if reference:
+        # The board_voltage readings go into their own array - the buffer only holds the channels used in the calculations.
+        readings = array('H', bytes(2 * numSamples))
+        views = dict(views, board_voltage=memoryview(readings))
+        scanned = with_reference(scanned)
+
+    # (read, channel views) for each chip, in scan order
+    reads = [(scan.read, [views[name] for name in names]) for scan, names in scanned]
+    for i in range(numSamples):
+        for read, views in reads:
+            for view, value in zip(views, read()):
+                view[i] = value
+
+    samples = buffer.as_samples()
+    if scan_list:
+        sampled = set(name for scan, names in scan_list for name in names)
+        for name in buffer.channels:
+            if name not in sampled:
+                del samples[name]
+    if reference:
+        samples['reference'] = sum(readings) / numSamples
     return samples
 
+def rising_crossings(v_samples, level, start=1, stop=None):
+    # Returns the (fractional, linearly interpolated) positions where v_samples rises through level, between start and stop.
+    crossings = []
+    previous = v_samples[start - 1]
+    for i in range(start, stop or len(v_samples)):
+        value = v_samples[i]
+        if previous < level <= value:
+            crossings.append(i - 1 + (level - previous) / (value - previous))
+        previous = value
+    return crossings
+
+def collect_cycles(numSamples, buffer=None, scan_list=None, max_samples=None, reference=False):
+    '''
+    Version of collect_data() that returns a whole number of mains cycles. A window that cuts through a cycle adds an error
+    to the real power and RMS values, which otherwise has to be averaged out over many windows.
+
+    numSamples is captured first, and the first rising zero crossing of the voltage wave (relative to its DC level) is found.
+    Sampling then carries on, one pass at a time, until the window starting at that crossing holds at least numSamples
+    samples and ends on a rising zero crossing. The returned samples are views over that part of the buffer.
+
+    buffer      : a SampleBuffer with room for max_samples per channel to reuse. A new one is allocated if not given.
+    scan_list   : only sample the channels in these scans, like collect_data()
+    max_samples : the most samples that will be captured while looking for the end of the last cycle. Defaults to 1.5 * numSamples.
+    reference   : also sample the board_voltage channel, like collect_data()
+
+    Returns the same dictionary as collect_data(), plus:
+        'cycles'    : number of whole mains cycles in the window
+        'frequency' : measured line frequency in Hz
+        'start'     : position of the first returned sample in the buffer
+    If the voltage wave doesn't cross its DC level (e.g. the AC adapter is unplugged), the first numSamples samples are
+    returned with 'cycles' set to 0 and 'frequency' set to None.
+    '''
+    max_samples = max_samples or numSamples * 3 // 2
+    if buffer is None or buffer.num_samples != max_samples:
+        buffer = SampleBuffer(channel_names, max_samples)
+    buffer.time = datetime.utcnow()
+    scan_list = scan_list or scans
+
+    views = buffer.views
+    scanned = scan_list
+    if reference:
+        readings = array('H', bytes(2 * max_samples))
+        views = dict(views, board_voltage=memoryview(readings))
+        scanned = with_reference(scan_list)
+
+    reads = [(scan.read, [views[name] for name in names]) for scan, names in scanned]
+    start_time = adc.clock()
+    for i in range(numSamples):
+        for read, views in reads:
+            for view, value in zip(views, read()):
+                view[i] = value
+
+    v_samples = buffer.channel('voltage')
+    level = sum(v_samples[:numSamples]) / numSamples
+    crossings = rising_crossings(v_samples, level, 1, numSamples)
+    count = numSamples
+    if crossings:
+        # The window runs from the first crossing to the first crossing at least numSamples after it.
+        target = crossings[0] + numSamples
+        previous = v_samples[count - 1]
+        while count < max_samples:
+            for read, views in reads:
+                for view, value in zip(views, read()):
+                    view[count] = value
+            value = v_samples[count]
+            if previous < level <= value:
+                crossings.append(count - 1 + (level - previous) / (value - previous))
+            previous = value
+            count += 1
+            if crossings[-1] >= target:
+                break
+    elapsed = adc.clock() - start_time
+
+    if len(crossings) > 1 and crossings[-1] >= target:
+        first, last = crossings[0], crossings[-1]
+        start, stop = round(first), round(last)
+        cycles = len(crossings) - 1
+        frequency = cycles / ((last - first) * elapsed / count)     # elapsed / count is the time per sample
+    else:
+        start, stop, cycles, frequency = 0, numSamples, 0, None
+
+    samples = {name: buffer.channel(name)[start:stop] for scan, names in scan_list for name in names}
+    samples['time'] = buffer.time
+    samples['buffer'] = buffer
+    samples['start'] = start
+    samples['cycles'] = cycles
+    samples['frequency'] = frequency
+    if reference:
+        samples['reference'] = sum(readings[:count]) / count
+    return samples
+
+def collect_sums(numSamples, chunk_size=250, keep_raw=False, scan_list=None, reference=False):
+    '''
+    Streaming version of collect_data(). Samples are captured into a small set of lists that are reused for every chunk,
+    and each chunk is folded into running sums (see accumulate_sums() in dsp.py) as soon as it is full. Memory use
+    therefore stays the same no matter how many samples are in the window.
+
+    Within a chunk, samples are taken back to back exactly like collect_data() does, so the phase calibration values
+    still apply. The previous voltage sample is carried over between chunks for the phase correction.
+
+    keep_raw  : also keep every raw sample in a SampleBuffer, returned under the 'raw' key in the same format as collect_data().
+                Only meant for debug mode.
+    scan_list : only sample the channels in these scans, like collect_data()
+    reference : also sample the board_voltage channel, like collect_data()
+
+    Returns the sums dictionary with 'time' (and 'raw' / 'reference', if requested) added. Use power_from_sums() in dsp.py to get the results.
+    '''
+    now = datetime.utcnow()
+
+    chunk_size = min(chunk_size, numSamples)
+    scan_list = scan_list or scans
+    sampled = [name for scan, names in scan_list for name in names]
+    chunk = {name: [0] * chunk_size for name in sampled}
+    if reference:
+        scan_list = with_reference(scan_list)
+        chunk['board_voltage'] = [0] * chunk_size
+        reference_sum = 0
+    reads = [(scan.read, [chunk[name] for name in names]) for scan, names in scan_list]
+    v_data = chunk['voltage']
+
+    if keep_raw:
+        raw = SampleBuffer(sampled, numSamples)
+        raw.time = now
+
+    sums = None
+    v_prev = None
+    remaining = numSamples
+    position = 0
+    while remaining > 0:
+        count = min(chunk_size, remaining)
+        for i in range(count):
+            for read, data in reads:
+                for values, value in zip(data, read()):
+                    values[i] = value
+
+        sums = merge_sums(sums, accumulate_sums(chunk, v_prev=v_prev, count=count))
+        v_prev = v_data[count - 1]
+        remaining -= count
+        if reference:
+            reference_sum += sum(chunk['board_voltage'][:count])
+
+        if keep_raw:
+            for name in sampled:
+                raw.channel(name)[position:position + count] = array('H', chunk[name][:count])
+        position += count
+
+    sums['time'] = now
+    if reference:
+        sums['reference'] = reference_sum / numSamples
+    if keep_raw:
+        sums['raw'] = raw.as_samples()
+    return sums
+
 def recover_influx_container():
-    docker_client = docker.from_env()
+    # Restarts the local InfluxDB container if it is stopped. Returns True if it was restarted, and False if it couldn't
+    # be (the caller decides whether to carry on without the database).
+    try:
+        docker_client = docker.from_env()
+    except docker.errors.DockerException as e:
+        logger.info(f"Could not connect to Docker to check the InfluxDB container ({e}).")
+        return False
 
     # Check to see if the influxdb container exists:
     containers = docker_client.containers.list(all=True)
@@ -128,6 +290,7 @@ def recover_influx_container():
                 sleep(5)
                 logger.info("... checking to see if the container is running now...")
                 sleep(0.5)
+                container_found = False
                 for _ in range(0,2):
                     # Make two attempts to see if the container is running now.
                     try:
@@ -138,7 +301,7 @@ def recover_influx_container():
                         continue
                 if not container_found:
                     logger.info("Couldn't find the container by name! Please open a Github issue as this is an unexpected result from this experimental implementation.")
-                    sys.exit()
+                    return False
 
                 if influx_container.attrs['State']['Status'] != 'running':
                     # Something must be wrong with the container - check for the exit code and grab the last few lines of logs to present to the user for further troubleshooting.
@@ -152,7 +315,7 @@ def recover_influx_container():
                     for line in logs.splitlines():
                         logger.info(f"   {line}")
                     
-                    sys.exit()
+                    return False
 
                 else:
                     logger.info("... container successfully started!")
@@ -26,62 +26,227 @@ db_settings = {
 }
 
 
-# Define Variables
-ct0_channel = 0             # Orange Pair           | House main (leg 1 - left)  (orange pair)
-ct1_channel = 1             # Green Pair            | House main (leg 2 - right) (green pair)
-ct2_channel = 2             # Blue Pair             | Subpanel main (leg 1 - top)
-ct3_channel = 3             # Brown Pair            | Solar Power 
-ct4_channel = 6             # 3.5mm Input #1        | Subpanel main (leg 2 - bottom)
-ct5_channel = 7             # 3.5mm Input #2        | Unused
-
-ct6_channel = 0             # Chip 2
-ct7_channel = 1             # Chip 2
-ct8_channel = 2             # Chip 2
-ct9_channel = 3             # Chip 2
-ct10_channel = 4            # Chip 2
-ct11_channel = 5            # Chip 2
-ct12_channel = 6            # Chip 2
-ct13_channel = 7            # Chip 2
-
-board_voltage_channel =  4  # Board voltage ~3.3V
-v_sensor_channel = 5        # 9V AC Voltage channel
-
-# The values from running the software in "phase" mode should go below!
-ct_phase_correction = {
-    'ct0' : 1,
-    'ct1' : 1,
-    'ct2' : 1,
-    'ct3' : 1,
-    'ct4' : 1,
-    'ct5' : 1,
-    
-    'ct6' : 1,
-    'ct7' : 1,
-    'ct8' : 1,
-    'ct9' : 1,
-    'ct10' : 1,
-    'ct11' : 1,
-    'ct12' : 1,
-    'ct13' : 1,
-}
-
-# AFTER phase correction is completed, these values are used in the final calibration for accuracy. See the documentation for more information.
-accuracy_calibration = {
-    'ct0' : 1,
-    'ct1' : 1,
-    'ct2' : 1,
-    'ct3' : 1,
-    'ct4' : 1,
-    'ct5' : 1,
-    
-    'ct6' : 1,
-    'ct7' : 1,
-    'ct8' : 1,
-    'ct9' : 1,
-    'ct10' : 1,
-    'ct11' : 1,
-    'ct12' : 1,
-    'ct13' : 1,
-    
-    'AC'  : 1,
+# SPI bus and chip select (device) of each MCP3008 on the board. To add a chip, add an entry here and list its inputs in channels below.
+adc_chips = {
+    0 : {'bus' : 0, 'device' : 0},      # Chip 1
+    1 : {'bus' : 0, 'device' : 1},      # Chip 2
+}
+
+# ADC backend. 'spidev' reads the MCP3008 chips on the board. 'simulated' generates the readings in software (see adc.py),
+# so the program can run on any Linux machine without the hardware - e.g. for testing and benchmarking. The backend can
+# also be chosen with the POWER_MONITOR_ADC environment variable, which takes precedence over this setting.
+adc_settings = {
+    'backend' : 'spidev',
+    'spi_speed_hz' : 1750000,       # Changing this value will require you to adjust the phasecal values.
+    'simulation' : {
+        'frequency' : 60,               # Mains frequency in Hz
+        'conversion_rate' : 60000,      # Simulated MCP3008 conversions per second (over all channels). Sets the simulated time between readings.
+        'seed' : None,                  # Seed for the noise. None gives different noise on every run.
+        # Waveform of each input, by channel table name. amplitude and offset are in ADC counts, phase is in degrees
+        # (relative to the voltage), harmonics maps a harmonic number to its amplitude as a fraction of the fundamental,
+        # and noise is the standard deviation of the gaussian noise in ADC counts. Inputs that aren't listed read
+        # 'default' - a CT with no current flowing.
+        'inputs' : {
+            'voltage' : {'amplitude' : 405, 'phase' : 0, 'harmonics' : {3 : 0.02, 5 : 0.01}, 'noise' : 1, 'offset' : 512},
+            'board_voltage' : {'amplitude' : 0, 'noise' : 0.5, 'offset' : 510},     # ~3.3V
+            'ct0' : {'amplitude' : 120, 'phase' : -15, 'harmonics' : {3 : 0.1}, 'noise' : 1.5, 'offset' : 511},
+            'ct1' : {'amplitude' : 80, 'phase' : -25, 'harmonics' : {3 : 0.05, 5 : 0.03}, 'noise' : 1.5, 'offset' : 512},
+            'ct2' : {'amplitude' : 60, 'phase' : -10, 'noise' : 1, 'offset' : 512},
+            'ct3' : {'amplitude' : 40, 'phase' : 180, 'noise' : 1, 'offset' : 513},
+            'ct4' : {'amplitude' : 20, 'phase' : -40, 'harmonics' : {3 : 0.3}, 'noise' : 1, 'offset' : 512},
+        },
+        'default' : {'amplitude' : 0, 'noise' : 1, 'offset' : 512},
+    },
+}
+
+# Channel table. Every loop in the program - sampling, the power calculations, the database writes and the plots - is driven by this table.
+# chip      : the MCP3008 the input is wired to (a key of adc_chips)
+# channel   : the input on that chip (0 - 7)
+# role      : 'main'          - a CT on a panel main. Its current is reported as negative while it is exporting power.
+#             'load'          - a CT on any other circuit (subpanel mains, branch circuits)
+#             'solar'         - a CT on a solar/generator input. Counted as production instead of consumption.
+#             'voltage'       - the 9V AC voltage sensor (exactly one)
+#             'board_voltage' - the ~3.3V board reference (exactly one)
+# phasecal  : the value from running the software in "phase" mode. Only used by CTs.
+# enabled   : optional, defaults to True. A disabled input is not sampled, calculated or written to the database, which raises
+#             the sample rate of every other input. Only CTs can be disabled. Since this changes the timing of the remaining
+#             inputs on the same chip, redo the phase calibration after enabling or disabling an input.
+# accuracy  : AFTER phase correction is completed, this value is used in the final calibration for accuracy. See the documentation for more information.
+#             The 'voltage' entry holds the accuracy calibration for the AC voltage.
+#
+# CTs must be named ct<number>. The inputs of each chip are sampled in the order they are listed here - changing the order will
+# require you to redo the phase calibration.
+channels = {
+    'ct0' : {'chip' : 0, 'channel' : 0, 'role' : 'main', 'phasecal' : 1, 'accuracy' : 1},     # Orange Pair       | House main (leg 1 - left)
+    'ct4' : {'chip' : 0, 'channel' : 6, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},     # 3.5mm Input #1    | Subpanel main (leg 2 - bottom)
+    'ct1' : {'chip' : 0, 'channel' : 1, 'role' : 'main', 'phasecal' : 1, 'accuracy' : 1},     # Green Pair        | House main (leg 2 - right)
+    'ct2' : {'chip' : 0, 'channel' : 2, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},     # Blue Pair         | Subpanel main (leg 1 - top)
+    'ct3' : {'chip' : 0, 'channel' : 3, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},     # Brown Pair        | Solar Power (set the role to 'solar' to count it as production)
+    'ct5' : {'chip' : 0, 'channel' : 7, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1, 'enabled' : False},   # 3.5mm Input #2    | Unused
+    'voltage' : {'chip' : 0, 'channel' : 5, 'role' : 'voltage', 'accuracy' : 1},              # 9V AC Voltage channel
+    'board_voltage' : {'chip' : 0, 'channel' : 4, 'role' : 'board_voltage'},                  # Board voltage ~3.3V
+
+    'ct6' : {'chip' : 1, 'channel' : 0, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct7' : {'chip' : 1, 'channel' : 1, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct8' : {'chip' : 1, 'channel' : 2, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct9' : {'chip' : 1, 'channel' : 3, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct10' : {'chip' : 1, 'channel' : 4, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct11' : {'chip' : 1, 'channel' : 5, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct12' : {'chip' : 1, 'channel' : 6, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+    'ct13' : {'chip' : 1, 'channel' : 7, 'role' : 'load', 'phasecal' : 1, 'accuracy' : 1},
+}
+
+# Acquisition settings. When 'threaded' is True, samples are collected in a background thread while the previous window is being processed and written to the DB.
+acquisition_settings = {
+    'threaded' : True,
+    'samples_per_window' : 2000,
+    'queue_depth' : 2,          # Number of captured windows that can wait for processing before the oldest one is dropped.
+    'streaming' : False,        # Fold samples into running sums while sampling instead of keeping every sample. Memory use stays constant, so very long windows (10k+ samples) are possible.
+    'align_to_cycles' : False,  # End every window on a whole number of mains cycles (see collect_cycles() in common.py), and write the measured line frequency. Not used with 'streaming' or the pipeline.
+}
+
+# Which implementation of the power calculations to use.
+# 'python' : the original pure-Python implementation (default)
+# 'numpy'  : vectorized implementation, requires numpy to be installed (pip3 install numpy). Produces identical results and uses much less CPU.
+# 'fused'  : pure-Python single pass that applies the phase correction algebraically instead of rebuilding a voltage wave for every CT.
+dsp_engine = 'python'
+
+# InfluxDB writer settings. Points are queued in memory and written in batches from a background thread, so a slow
+# or unreachable database never holds up sampling.
+influx_writer_settings = {
+    'enabled' : True,
+    'batch_size' : 500,         # Maximum number of points per write request
+    'flush_interval' : 5,       # Maximum number of seconds between writes
+    'queue_size' : 20000,       # Maximum number of points held in memory. The oldest points are dropped when this is exceeded.
+}
+
+# On-disk spool for points that couldn't be written because InfluxDB was unreachable. Spooled points are written to
+# InfluxDB in rate-limited chunks once it is reachable again (including after a restart of this program).
+spool_settings = {
+    'enabled' : True,
+    'directory' : 'data/spool',
+    'segment_size' : 1000000,       # Bytes per segment file
+    'max_size' : 100000000,         # Total size limit in bytes. The oldest segments are deleted when this is exceeded.
+    'replay_chunk_size' : 5000,     # Points per replay request
+    'replay_interval' : 1,          # Minimum number of seconds between replay requests
+}
+
+# Schema used when writing to InfluxDB.
+# 'narrow' : the original schema - home_load, solar, net, voltages, and one raw_cts point per CT (tagged by ct number)
+# 'wide'   : a single point per interval in the 'readings' measurement, with fields such as ct0_power, ct0_current, ct0_pf, net_power and voltage
+# 'both'   : write both schemas, e.g. while migrating Grafana dashboards from one to the other
+influx_schema = 'narrow'
+
+# On-device rollups. Every reading is folded into each of these windows, which are aligned to wall-clock boundaries
+# (UTC). When a window closes, one point with the mean, min and max of every value (plus the energy in Wh for every
+# power value, e.g. ct0_energy_wh) is written to the window's measurement. Set retention_policy to write a window to
+# an InfluxDB retention policy other than the default - the policy must already exist.
+# Off by default, since it adds a measurement per window. Set 'enabled' to True to turn it on. 'raw_average' applies
+# either way.
+rollup_settings = {
+    'enabled' : False,
+    'raw_average' : 2,      # Number of readings averaged into each point of the raw (home_load, solar, net, raw_cts ...) series
+    'max_gap' : 5,          # Seconds. A longer gap between two readings (e.g. a restart) isn't counted towards the energy totals.
+    'windows' : [
+        {'interval' : 1,   'measurement' : 'rollup_1s',  'retention_policy' : None},
+        {'interval' : 60,  'measurement' : 'rollup_1m',  'retention_policy' : None},
+        {'interval' : 900, 'measurement' : 'rollup_15m', 'retention_policy' : None},
+    ],
+}
+
+# Multi-process pipeline. When enabled, acquisition and the power calculations run in their own processes (with raw
+# sample windows passed through shared memory), and the main process only aggregates and writes the results. This
+# spreads the work over several cores. Replaces the acquisition thread - the 'threaded' and 'streaming' acquisition
+# settings are ignored while the pipeline is enabled.
+pipeline_settings = {
+    'enabled' : False,
+    'slots' : 4,            # Number of sample windows in the shared memory ring
+    'cpus' : {              # CPU to pin each stage to, or None to let the scheduler decide
+        'acquisition' : 1,
+        'dsp' : 2,
+        'output' : 3,
+    },
+}
+
+# Adaptive sampling schedule. When enabled, a CT whose RMS current has stayed below 'idle_current' for 'idle_after'
+# windows in a row is only sampled in every 'idle_every'-th window, and the busy CTs are sampled faster in the others.
+# Before each window the idle CTs get a short probe scan, and a CT whose readings are no longer flat is sampled again
+# right away. The last readings of an idle CT are repeated in the windows it is left out of.
+# Leaving channels out of a scan changes the time between the voltage and CT samples slightly, so the phase calibration
+# is only exact for windows in which every CT is sampled. Ignored while the pipeline is enabled.
+scheduler_settings = {
+    'enabled' : False,
+    'idle_current' : 0.5,           # Amps
+    'idle_after' : 5,               # Windows
+    'idle_every' : 10,              # Windows
+    'always_on' : ('main', 'solar'),    # CT roles that are never left out
+    'probe_samples' : 32,
+    'probe_threshold' : 8,          # ADC counts
+}
+
+# Board reference voltage. Every reading is scaled by the ~3.3V rail, which is sampled along with the other channels in
+# one window every 'refresh_interval' seconds and smoothed with an exponential moving average. A reading that differs
+# from the average by more than 'drift_alarm' volts is logged as a warning. With the pipeline enabled, the rail is read
+# in a short burst of its own every 'refresh_interval' seconds instead.
+reference_settings = {
+    'refresh_interval' : 10,        # Seconds. 0 samples the rail in every window.
+    'smoothing' : 0.2,              # Weight of every new reading in the average (0 - 1)
+    'drift_alarm' : 0.1,            # Volts
+}
+
+# Self-monitoring. Every stage of the main loop (board voltage, acquisition, DSP, aggregation and the InfluxDB writes)
+# is timed, and every 'interval' seconds a summary is written to the 'measurement' measurement: the count, mean, p50,
+# p95 and max time of every stage, the achieved sample rate and the jitter of the interval between windows. The same
+# table is shown in terminal mode. With the pipeline enabled, acquisition and DSP run in other processes and only the
+# time spent waiting for them is reported. Off by default - set 'enabled' to True to write the measurement and show the
+# table in debug mode.
+perf_settings = {
+    'enabled' : False,
+    'interval' : 60,
+    'measurement' : 'monitor_perf',
+}
+
+# Prometheus endpoint. When enabled, the latest reading of every CT, the home load, solar, net and voltage values and
+# the acquisition and InfluxDB writer counters are served in the Prometheus text format on http://<host>:<port>/metrics.
+metrics_settings = {
+    'enabled' : False,
+    'host' : '0.0.0.0',
+    'port' : 9110,
+}
+
+# Live stream of every reading (see publish.py). Subscribers connect to the Unix socket, or to the WebSocket if a port
+# is set. A subscriber that can't keep up loses its oldest frames - it never slows the monitor down.
+publish_settings = {
+    'enabled' : False,
+    'unix_socket' : 'data/live.sock',
+    'websocket_port' : None,        # e.g. 8765
+    'websocket_host' : '0.0.0.0',
+    'encoding' : 'json',            # 'json' or 'msgpack' (requires pip3 install msgpack)
+    'buffer_size' : 100,            # Frames buffered per subscriber
+}
+
+# Harmonic analysis. Every 'interval' seconds, the voltage channel and every CT of one window are analyzed in a background
+# thread (see harmonics.py), and the RMS value of each of the first 'harmonics' harmonics and the total harmonic
+# distortion of every channel are written to the 'measurement' measurement. CTs carrying less than 'min_current' amps are
+# left out. Requires numpy. Not available with 'streaming' or the pipeline, which don't keep the raw samples in this process.
+harmonics_settings = {
+    'enabled' : False,
+    'interval' : 60,                # Seconds
+    'harmonics' : 15,               # Including the fundamental
+    'min_current' : 0.1,            # Amps
+    'measurement' : 'harmonics',
+}
+
+# Energy counters. The real power of the home load, the solar production, the net import and export and every CT is
+# integrated into cumulative kWh counters (see energy.py). They are checkpointed to 'path' every 'checkpoint_interval'
+# seconds and restored at startup, and the checkpointed values are written to the 'measurement' measurement (totals) and
+# '<measurement>_cts' (tagged by CT number). The counters never go down, so the energy over a period is the difference of
+# two last-value queries. Not used in replay mode. Off by default - set 'enabled' to True to start counting.
+energy_settings = {
+    'enabled' : False,
+    'path' : 'data/energy.json',
+    'checkpoint_interval' : 60,     # Seconds. The energy since the last checkpoint is lost after a crash or power cut.
+    'max_gap' : 5,                  # Seconds. A longer gap between two readings (e.g. a restart) isn't counted. Keep it equal to
+                                    # rollup_settings['max_gap'] so the counters agree with the rollup energy totals.
+    'measurement' : 'energy',
 }
@@ -0,0 +1,261 @@
+# This module contains alternate implementations of the power calculations that are done in power-monitor.py.
+# The pure-Python calculate_power() and rebuild_waves() in power-monitor.py are the reference implementation, and
+# they are used as the fallback when the engine selected in config.py isn't available.
+
+from itertools import chain
+from math import sqrt
+from operator import mul
+from config import logger, channels, GRID_VOLTAGE, AC_TRANSFORMER_OUTPUT_VOLTAGE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+AC_voltage_ratio = (GRID_VOLTAGE / AC_TRANSFORMER_OUTPUT_VOLTAGE) * 11   # This is a rough approximation of the ratio
+AC_voltage_accuracy_factor = channels['voltage']['accuracy']
+
+# Roles in the channel table (see config.py) that are current transformers
+CT_ROLES = ('main', 'load', 'solar')
+
+# Every enabled CT in the channel table, in CT number order (CTs are named ct<number>). This is also the row order of the
+# (channels, samples) array used by calculate_power_numpy(): the CTs followed by the voltage channel. The sampling order
+# is the channel table order - see build_scans() in common.py.
+ct_names = sorted((name for name, channel in channels.items() if channel['role'] in CT_ROLES and channel.get('enabled', True)), key=lambda name: int(name[2:]))
+channel_names = ct_names + ['voltage']
+
+
+def select_engine(requested):
+    # Returns the name of the DSP engine to use, falling back to the pure-Python engine if the requested one can't be used.
+    if requested == 'numpy':
+        if np is None:
+            logger.info("... numpy is not installed. Falling back to the pure-Python power calculations.")
+            return 'python'
+        return 'numpy'
+
+    if requested == 'fused':
+        return 'fused'
+
+    if requested != 'python':
+        logger.info(f"... Unknown dsp_engine '{requested}' in config.py. Using the pure-Python power calculations.")
+    return 'python'
+
+
+def sampled_cts(samples):
+    # Returns the CTs that are present in a samples (or sums) dictionary, in ct_names order. Every CT is present unless
+    # the window was captured by the adaptive scheduler (see scheduler.py), which skips idle CTs in some windows.
+    return [name for name in ct_names if name in samples]
+
+
+def samples_to_array(samples):
+    # Returns the (channels, samples) array used by calculate_power_numpy() for the dictionary returned by collect_data(),
+    # with a row for every CT in sampled_cts(samples) followed by the voltage row.
+    # When the samples are held in a SampleBuffer with the same channel order, the array is a view over the buffer (no copy).
+    # A window that only covers part of the buffer (see collect_cycles()) starts at samples['start'].
+    names = sampled_cts(samples) + ['voltage']
+    buffer = samples.get('buffer')
+    if buffer is not None and buffer.channels == names:
+        start = samples.get('start', 0)
+        data = np.frombuffer(buffer.data, dtype=np.uint16).reshape(len(names), buffer.num_samples)
+        return data[:, start:start + len(samples['voltage'])]
+    return np.array([samples[name] for name in names], dtype=np.int64)
+
+
+def calculate_power_numpy(data, board_voltage, names=None):
+    '''
+    Vectorized version of rebuild_waves() + calculate_power() from power-monitor.py. The results are identical to the
+    pure-Python implementation, including the truncation of the phase corrected voltage samples to integers.
+
+    data            : 2-D integer array of shape (channels, samples), with one row per CT in names followed by the voltage row
+    board_voltage   : float, current reading of the reference voltage from the +3.3V rail
+    names           : the CTs in data, in row order. Defaults to ct_names.
+
+    Returns the same dictionary as calculate_power().
+    '''
+    if names is None:
+        names = ct_names
+    cts = np.asarray(data[:-1], dtype=np.int64)
+    v = np.asarray(data[-1], dtype=np.float64)
+    num_samples = v.shape[0]
+
+    # Phase corrected voltage wave for every CT at once (one row per CT). The first point of each wave is the
+    # original first voltage sample, which is what previous_point == current_point gives us below.
+    phasecal = np.array([channels[name]['phasecal'] for name in names], dtype=np.float64)[:, np.newaxis]
+    v_prev = np.concatenate((v[:1], v[:-1]))
+    waves = np.trunc(v_prev + phasecal * (v - v_prev)).astype(np.int64)
+
+    # Scaling factors
+    vref = board_voltage / 1024
+    ct_scaling_factors = np.array([vref * 100 * channels[name]['accuracy'] for name in names], dtype=np.float64)
+    voltage_scaling_factor = vref * AC_voltage_ratio * AC_voltage_accuracy_factor
+
+    # All of the sums are exact integer sums, so the float math below sees exactly the same inputs as calculate_power().
+    sum_raw_current = cts.sum(axis=1)
+    sum_raw_voltage = waves.sum(axis=1)
+    sum_inst_power = (cts * waves).sum(axis=1)
+    sum_squared_current = (cts * cts).sum(axis=1)
+    sum_squared_voltage = (waves * waves).sum(axis=1)
+
+    avg_raw_current = sum_raw_current / num_samples
+    avg_raw_voltage = sum_raw_voltage / num_samples
+
+    real_power = ((sum_inst_power / num_samples) - (avg_raw_current * avg_raw_voltage)) * ct_scaling_factors * voltage_scaling_factor
+
+    mean_square_current = sum_squared_current / num_samples
+    mean_square_voltage = sum_squared_voltage / num_samples
+
+    # np.maximum() guards against a tiny negative variance caused by float rounding on a flat signal, like power_from_sums().
+    rms_current = np.sqrt(np.maximum(mean_square_current - (avg_raw_current * avg_raw_current), 0)) * ct_scaling_factors
+    rms_voltage = np.sqrt(np.maximum(mean_square_voltage - (avg_raw_voltage * avg_raw_voltage), 0)) * voltage_scaling_factor
+
+    # Power Factor (0 when there is no apparent power, like calculate_power())
+    apparent_power = rms_voltage * rms_current
+    power_factor = np.divide(real_power, apparent_power, out=np.zeros_like(real_power), where=apparent_power != 0)
+
+    real_power = real_power.tolist()
+    rms_current = rms_current.tolist()
+    rms_voltage = rms_voltage.tolist()
+    power_factor = power_factor.tolist()
+
+    results = {}
+    for i, name in enumerate(names):
+        results[name] = {
+            'type'      : 'consumption',
+            'power'     : real_power[i],
+            'current'   : rms_current[i],
+            'voltage'   : rms_voltage[i],
+            'pf'        : power_factor[i],
+        }
+    results['voltage'] = rms_voltage[0]
+
+    return results
+
+
+def accumulate_sums(samples, v_prev=None, count=None):
+    '''
+    Single pass over a collect_data() dictionary that gathers every sum needed to calculate the phase corrected power,
+    without building the phase corrected voltage waves.
+
+    For sample i, the phase corrected voltage is  V = p + PHASECAL * (q - p),  where q is the voltage sample taken at
+    the same time as the CT sample and p is the previous voltage sample (for the first sample, p = q). Because V is
+    linear in p and q, every sum over V can be rebuilt from sums over p and q for any PHASECAL - see power_from_sums().
+
+    v_prev  : the voltage sample that preceded this block of samples, when the samples are one chunk of a longer
+              window (see collect_sums() in common.py). Defaults to the first voltage sample.
+    count   : only use the first count samples of each list. Defaults to all of them.
+    '''
+    if count is not None and count != len(samples['voltage']):
+        samples = {name: samples[name][:count] for name in sampled_cts(samples) + ['voltage']}
+
+    v_samples = samples['voltage']
+    num_samples = len(v_samples)
+    if v_prev is None:
+        v_prev = v_samples[0]
+    v_last = v_samples[-1]
+
+    # chain() yields the previous voltage sample for each index without copying the voltage list.
+    def previous_v():
+        return chain((v_prev,), v_samples)
+
+    sums = {
+        'count'         : num_samples,
+        'v'             : sum(v_samples),                                   # sum(q)
+        'v_sq'          : sum(map(mul, v_samples, v_samples)),              # sum(q * q)
+        'v_cross'       : sum(map(mul, v_samples, previous_v())),           # sum(p * q)
+        'cts'           : {},
+    }
+    sums['v_prev'] = sums['v'] - v_last + v_prev                                     # sum(p)
+    sums['v_prev_sq'] = sums['v_sq'] - v_last * v_last + v_prev * v_prev             # sum(p * p)
+
+    for name in sampled_cts(samples):
+        ct_samples = samples[name]
+        sums['cts'][name] = {
+            'sum'       : sum(ct_samples),                                  # sum(ct)
+            'sq'        : sum(map(mul, ct_samples, ct_samples)),            # sum(ct * ct)
+            'v'         : sum(map(mul, ct_samples, v_samples)),             # sum(ct * q)
+            'v_prev'    : sum(map(mul, ct_samples, previous_v())),          # sum(ct * p)
+        }
+
+    return sums
+
+
+def merge_sums(total, sums):
+    # Adds the sums from accumulate_sums() into total (which may be None) and returns total.
+    if total is None:
+        return sums
+
+    for key in ('count', 'v', 'v_prev', 'v_sq', 'v_prev_sq', 'v_cross'):
+        total[key] += sums[key]
+    for name, ct in sums['cts'].items():
+        total_ct = total['cts'][name]
+        for key in ct:
+            total_ct[key] += ct[key]
+    return total
+
+
+def power_from_sums(sums, board_voltage):
+    '''
+    Derives the phase corrected power, RMS current, RMS voltage and PF for every CT from the sums returned by
+    accumulate_sums(). Matches rebuild_waves() + calculate_power() to within float tolerance - the only difference is
+    that calculate_power() truncates each phase corrected voltage sample to an integer, and this does not.
+
+    Returns the same dictionary as calculate_power().
+    '''
+    num_samples = sums['count']
+    sum_p = sums['v_prev']
+    sum_q = sums['v']
+    sum_pp = sums['v_prev_sq']
+    sum_qq = sums['v_sq']
+    sum_pq = sums['v_cross']
+
+    # Scaling factors
+    vref = board_voltage / 1024
+    voltage_scaling_factor = vref * AC_voltage_ratio * AC_voltage_accuracy_factor
+
+    results = {}
+    names = sampled_cts(sums['cts'])
+    for name in names:
+        ct = sums['cts'][name]
+        phasecal = channels[name]['phasecal']
+        ct_scaling_factor = vref * 100 * channels[name]['accuracy']
+
+        # Sums over V = p + PHASECAL * (q - p)
+        sum_raw_voltage = sum_p + phasecal * (sum_q - sum_p)
+        sum_squared_voltage = sum_pp + 2 * phasecal * (sum_pq - sum_pp) + phasecal * phasecal * (sum_qq - 2 * sum_pq + sum_pp)
+        sum_inst_power = ct['v_prev'] + phasecal * (ct['v'] - ct['v_prev'])
+
+        avg_raw_current = ct['sum'] / num_samples
+        avg_raw_voltage = sum_raw_voltage / num_samples
+
+        real_power = ((sum_inst_power / num_samples) - (avg_raw_current * avg_raw_voltage)) * ct_scaling_factor * voltage_scaling_factor
+
+        mean_square_current = ct['sq'] / num_samples
+        mean_square_voltage = sum_squared_voltage / num_samples
+
+        # max() guards against a tiny negative variance caused by float rounding on a flat signal.
+        rms_current = sqrt(max(mean_square_current - (avg_raw_current * avg_raw_current), 0)) * ct_scaling_factor
+        rms_voltage = sqrt(max(mean_square_voltage - (avg_raw_voltage * avg_raw_voltage), 0)) * voltage_scaling_factor
+
+        # Power Factor
+        apparent_power = rms_voltage * rms_current
+        try:
+            power_factor = real_power / apparent_power
+        except ZeroDivisionError:
+            power_factor = 0
+
+        results[name] = {
+            'type'      : 'consumption',
+            'power'     : real_power,
+            'current'   : rms_current,
+            'voltage'   : rms_voltage,
+            'pf'        : power_factor,
+        }
+
+    results['voltage'] = results[names[0]]['voltage']
+    return results
+
+
+def calculate_power_fused(samples, board_voltage):
+    # Fused replacement for rebuild_waves() + calculate_power(). Takes the dictionary returned by collect_data().
+    return power_from_sums(accumulate_sums(samples), board_voltage)
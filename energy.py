@@ -0,0 +1,138 @@
+# This module contains the energy counters used by power-monitor.py when energy_settings['enabled'] is set.
+# The real power of every reading is integrated over the time since the previous reading into cumulative kWh counters,
+# like the energy totals of the rollups (see rollups.py), but the counters never reset. Crediting each window with the
+# time since the previous one started also covers the processing time between windows, dropped windows and the
+# scheduler's probes, so the counters follow the wall clock. Only gaps longer than max_gap (e.g. a restart) are left
+# out, the same way the rollups leave them out.
+#
+# The counters are checkpointed to disk every energy_settings['checkpoint_interval'] seconds and restored at startup,
+# and the checkpointed values are written to InfluxDB - so the counters only ever go up, and the energy used over any
+# period is the difference between two last-value queries instead of an integral() over months of raw points.
+#
+# Only values that are safely on disk are written to InfluxDB. After a crash or power cut, the counters carry on from
+# the last checkpoint, so the energy since that checkpoint is lost but no written value is ever higher than a later one.
+
+import os
+import json
+from time import monotonic
+from config import logger
+from dsp import ct_names
+from influx_interface import LinePoint, EPOCH, to_ms
+
+# Fields of the energy measurement
+TOTAL_FIELDS = ('home_load_kwh', 'solar_kwh', 'net_import_kwh', 'net_export_kwh')
+
+
+class EnergyCounters():
+    '''
+    Cumulative kWh counters for the home load, solar production, net import and export, and every CT.
+    path                : file the counters are checkpointed to
+    checkpoint_interval : seconds between checkpoints (see due())
+    max_gap             : a reading that arrives more than this many seconds after the previous one doesn't count the
+                          gap, since nothing is known about the power during it
+    measurement         : InfluxDB measurement for the totals. The CT counters go to <measurement>_cts, tagged by CT number,
+                          with the energy used while the CT's power was positive in kwh and while it was negative (e.g. a
+                          main CT while exporting) in reverse_kwh.
+
+    counters            : dictionary of counter name -> kWh, e.g. 'home_load_kwh' or 'ct0_reverse_kwh'
+    '''
+    def __init__(self, path='data/energy.json', checkpoint_interval=60, max_gap=5, measurement='energy'):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.max_gap = max_gap
+        self.counters = {name : 0 for name in TOTAL_FIELDS}
+        for name in ct_names:
+            self.counters[f'{name}_kwh'] = 0
+            self.counters[f'{name}_reverse_kwh'] = 0
+        self.total_point = LinePoint(measurement, TOTAL_FIELDS)
+        self.ct_points = {name : LinePoint(f'{measurement}_cts', ('kwh', 'reverse_kwh'), {'ct' : name[2:]}) for name in ct_names}
+        self._last_timestamp = None
+        self._last_checkpoint = monotonic()
+        self._restore()
+        self.checkpointed = dict(self.counters)      # The values that are on disk
+
+    def _restore(self):
+        if not os.path.exists(self.path):
+            logger.info(f"... No energy counters found in {self.path} - starting from zero.")
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)['counters']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read the energy counters from {self.path} ({e}). Starting from zero - the written energy totals will start over.")
+            return
+        # Counters of CTs that are currently disabled are kept, so they carry on if the CT is enabled again.
+        self.counters.update(saved)
+        logger.info(f"... Restored the energy counters from {self.path} ({round(self.counters['home_load_kwh'], 3)} kWh home load)")
+
+    def add(self, poll_time, home_load_power, solar_power, net_power, results):
+        '''
+        poll_time       : naive UTC datetime of the reading
+        home_load_power, solar_power, net_power : the aggregated power in watts, as calculated in run_main()
+        results         : the results dictionary of the window (see calculate_power())
+        '''
+        timestamp = (poll_time - EPOCH).total_seconds()
+        if self._last_timestamp is None:
+            duration = 0
+        else:
+            duration = timestamp - self._last_timestamp
+            if duration < 0 or duration > self.max_gap:
+                duration = 0
+        self._last_timestamp = timestamp
+        if not duration:
+            return
+
+        hours = duration / 3600
+        counters = self.counters
+        counters['home_load_kwh'] += max(home_load_power, 0) * hours / 1000
+        counters['solar_kwh'] += max(solar_power, 0) * hours / 1000
+        if net_power > 0:
+            counters['net_import_kwh'] += net_power * hours / 1000
+        else:
+            counters['net_export_kwh'] -= net_power * hours / 1000
+        for name in ct_names:
+            power = results[name]['power']
+            if power > 0:
+                counters[f'{name}_kwh'] += power * hours / 1000
+            else:
+                counters[f'{name}_reverse_kwh'] -= power * hours / 1000
+
+    def due(self):
+        return monotonic() - self._last_checkpoint >= self.checkpoint_interval
+
+    def checkpoint(self):
+        '''
+        Writes the counters to path atomically: they are written to a temporary file that is synced to disk and then
+        renamed over the previous checkpoint, so a crash at any point leaves either the old or the new counters.
+        Returns True if the checkpoint was written.
+        '''
+        self._last_checkpoint = monotonic()
+        counters = dict(self.counters)
+        temp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump({'counters' : counters}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            # Sync the directory too, so the rename itself survives a power cut.
+            directory = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        except OSError as e:
+            logger.warning(f"Could not checkpoint the energy counters to {self.path} ({e}). Will try again later.")
+            return False
+        self.checkpointed = counters
+        return True
+
+    def lines(self, poll_time):
+        # Returns the line protocol points for the checkpointed counters.
+        timestamp = to_ms(poll_time)
+        counters = self.checkpointed
+        lines = [self.total_point.line([counters[name] for name in TOTAL_FIELDS], timestamp)]
+        for name, point in self.ct_points.items():
+            lines.append(point.line((counters[f'{name}_kwh'], counters[f'{name}_reverse_kwh']), timestamp))
+        return lines
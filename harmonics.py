@@ -0,0 +1,145 @@
+# This module contains the harmonic analysis used by power-monitor.py when harmonics_settings['enabled'] is set.
+# Every harmonics_settings['interval'] seconds, the main loop hands a copy of the current window to a background
+# thread, which takes the FFT of the voltage channel and every CT in a single batched numpy call. The RMS magnitude of
+# the first harmonics and the total harmonic distortion (THD) of every channel are written to the harmonics measurement.
+#
+# A window is only handed over when no other window is waiting, so a slow analysis skips windows instead of holding up the
+# main loop. Requires numpy (pip3 install numpy).
+
+import threading
+from queue import Queue, Empty, Full
+from time import monotonic
+from config import channels, logger
+from dsp import AC_voltage_ratio, AC_voltage_accuracy_factor, sampled_cts, samples_to_array
+import influx_interface as infl
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def harmonics_available():
+    # Returns True if numpy is installed. The harmonic analysis is disabled otherwise.
+    if np is None:
+        logger.info("... numpy is not installed (pip3 install numpy). The harmonic analysis is disabled.")
+        return False
+    return True
+
+
+def harmonic_spectrum(data, scaling, harmonics):
+    '''
+    Measures the harmonics of every row of a (channels, samples) array at once. The fundamental is taken from the last
+    row (the voltage channel), and the other rows are measured at the same frequencies.
+
+    data        : 2-D array of raw ADC readings, one row per channel, with the voltage channel last
+    scaling     : per-row factor that converts ADC counts to volts or amps
+    harmonics   : number of harmonics to measure, including the fundamental
+
+    Returns (magnitudes, thd): magnitudes is a (channels, harmonics) array of the RMS value of every harmonic in volts or
+    amps (0 for harmonics above the Nyquist frequency), and thd is the total harmonic distortion of every row in percent
+    (0 for a row without a fundamental).
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    num_samples = data.shape[1]
+    window = np.hanning(num_samples)
+    # DC is removed first, so that it doesn't leak into the low bins.
+    power = np.abs(np.fft.rfft((data - data.mean(axis=1, keepdims=True)) * window, axis=1)) ** 2
+    num_bins = power.shape[1]
+
+    # The fundamental is the strongest bin of the voltage spectrum, refined between bins by a parabola through the log
+    # magnitudes around it. Bins 0 and 1 are skipped (the Hann window spreads what's left of DC into bin 1).
+    voltage = power[-1]
+    peak = int(np.argmax(voltage[2:-1])) + 2
+    a, b, c = np.log(voltage[peak - 1:peak + 2] + 1e-12)
+    fundamental = peak + (0.5 * (a - c) / (a - 2 * b + c) if a - 2 * b + c else 0)
+
+    # The Hann window spreads every harmonic over its 2 neighbouring bins on each side, so the power of harmonic k is
+    # the sum of the 5 bins around k * fundamental. With Parseval's theorem, that gives the RMS value of the harmonic.
+    count = min(harmonics, int((num_bins - 3) / fundamental))
+    centres = np.rint(np.arange(1, count + 1) * fundamental).astype(np.int64)
+    lobes = power[:, centres[:, np.newaxis] + np.arange(-2, 3)].sum(axis=2)
+    magnitudes = np.zeros((data.shape[0], harmonics))
+    magnitudes[:, :count] = np.sqrt(2 * lobes / (num_samples * np.sum(window * window)))
+    magnitudes *= np.asarray(scaling, dtype=np.float64)[:, np.newaxis]
+
+    fundamentals = magnitudes[:, 0]
+    distortion = np.sqrt(np.sum(magnitudes[:, 1:] ** 2, axis=1))
+    thd = np.divide(distortion * 100, fundamentals, out=np.zeros_like(fundamentals), where=fundamentals > 0)
+    return magnitudes, thd
+
+
+class HarmonicAnalyzer(threading.Thread):
+    '''
+    Analyzes one window every interval seconds in the background and writes the results to InfluxDB.
+    interval    : seconds between analyses
+    harmonics   : number of harmonics to measure, including the fundamental. They are written as the fields h1, h2 ...
+    min_current : CTs carrying less than this many amps at the fundamental are left out - the THD of an idle CT is just noise
+    measurement : InfluxDB measurement to write to. Every point is tagged with the channel name (ct0 ... or voltage).
+
+    latest      : {channel : (thd, [h1, h2, ...])} from the last analysis, or None
+
+    submit() is called from the main loop for every window, and returns right away.
+    '''
+    def __init__(self, interval=60, harmonics=15, min_current=0.1, measurement='harmonics'):
+        super().__init__(name='harmonics', daemon=True)
+        self.interval = interval
+        self.harmonics = harmonics
+        self.min_current = min_current
+        self.measurement = measurement
+        self.latest = None
+        self._queue = Queue(maxsize=1)
+        self._stop_event = threading.Event()
+        self._next = monotonic()
+        self._points = {}
+
+    def submit(self, poll_time, samples, board_voltage):
+        # Hands a copy of the window to the analysis thread if an analysis is due and the thread is idle.
+        # samples is a dictionary returned by collect_data() - its buffer may be reused as soon as this returns.
+        if monotonic() < self._next or self._queue.full():
+            return False
+        names = sampled_cts(samples) + ['voltage']
+        data = np.array(samples_to_array(samples), dtype=np.float64)
+        try:
+            self._queue.put_nowait((poll_time, names, data, board_voltage))
+        except Full:
+            return False
+        self._next = monotonic() + self.interval
+        return True
+
+    def _point(self, name):
+        point = self._points.get(name)
+        if point is None:
+            fields = ('thd',) + tuple(f'h{k}' for k in range(1, self.harmonics + 1))
+            point = self._points[name] = infl.LinePoint(self.measurement, fields, {'channel' : name})
+        return point
+
+    def analyze(self, names, data, board_voltage):
+        # Returns {channel : (thd, [h1, h2, ...])} for a window. See harmonic_spectrum().
+        vref = board_voltage / 1024
+        scaling = [vref * 100 * channels[name]['accuracy'] for name in names[:-1]] + [vref * AC_voltage_ratio * AC_voltage_accuracy_factor]
+        magnitudes, thd = harmonic_spectrum(data, scaling, self.harmonics)
+        results = {}
+        for i, name in enumerate(names):
+            if name != 'voltage' and magnitudes[i, 0] < self.min_current:
+                continue
+            results[name] = (float(thd[i]), magnitudes[i].tolist())
+        return results
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                poll_time, names, data, board_voltage = self._queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                results = self.analyze(names, data, board_voltage)
+            except Exception as e:
+                logger.warning(f"Harmonic analysis failed: {e}")
+                continue
+            self.latest = results
+            timestamp = infl.to_ms(poll_time)
+            infl.write_points([self._point(name).line([thd] + magnitudes, timestamp) for name, (thd, magnitudes) in results.items()])
+
+    def stop(self):
+        self._stop_event.set()
@@ -1,9 +1,13 @@
 from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBServerError
-from datetime import datetime
+from influxdb.exceptions import InfluxDBServerError, InfluxDBClientError
+from datetime import datetime, timedelta
 import random
-from time import sleep
-from config import logger, db_settings
+import threading
+from queue import Queue, Empty, Full
+from time import sleep, monotonic
+from config import logger, db_settings, influx_writer_settings, spool_settings, influx_schema
+from spool import Spool
+from dsp import ct_names
 from requests.exceptions import ConnectionError
 
 # For development only
@@ -144,10 +148,293 @@ class Point():
 
 
 
+class InfluxWriter(threading.Thread):
+    '''
+    Background writer that batches points and sends them to InfluxDB from its own thread, so the sampling loop never
+    waits on the network.
+
+    batch_size      : maximum number of points sent in a single request
+    flush_interval  : maximum number of seconds a point waits before it is sent
+    queue_size      : maximum number of points held in memory. When the queue is full (i.e. InfluxDB is slow or down),
+                      the oldest points are dropped to make room for new ones.
+    spool           : optional Spool (see spool.py). Batches that can't be written because InfluxDB is unreachable are
+                      saved to it, and replayed in chunks of replay_chunk_size points, at most one chunk every
+                      replay_interval seconds, once writes succeed again.
+
+    metrics() returns the current queue depth, write latency and counters.
+    '''
+    def __init__(self, batch_size=500, flush_interval=5, queue_size=20000, spool=None, replay_chunk_size=5000, replay_interval=1):
+        super().__init__(name='influx-writer', daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.replay_chunk_size = replay_chunk_size
+        self.replay_interval = replay_interval
+        self._last_replay = 0
+        self._connected = True
+        self._queue = Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._retry = []                # Batch that failed with a connection error and will be sent again
+
+        self.points_written = 0
+        self.points_dropped = 0
+        self.batches_written = 0
+        self.batches_failed = 0
+        self.last_latency = 0           # Duration of the last write request, in seconds
+        self.max_latency = 0
+        self.avg_latency = 0            # Exponential moving average of the write request duration
+        self.points_spooled = 0
+        self.points_replayed = 0
+
+    def enqueue(self, points, retention_policy=None):
+        # Adds points to the queue without blocking. Never raises, even if InfluxDB is unreachable.
+        for point in points:
+            while True:
+                try:
+                    self._queue.put_nowait((retention_policy, point))
+                    break
+                except Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.points_dropped += 1
+                    except Empty:
+                        pass
+
+    def run(self):
+        batch = list(self._retry)
+        deadline = monotonic() + self.flush_interval
+        while True:
+            stopping = self._stop_event.is_set()
+            if stopping and self._queue.empty() and not batch:
+                break
+
+            try:
+                if len(batch) < self.batch_size:
+                    # Waits at most a second at a time, so that stop() is noticed quickly.
+                    batch.append(self._queue.get(timeout=0 if stopping else min(1, max(0, deadline - monotonic()))))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+
+            if len(batch) >= self.batch_size or monotonic() >= deadline or stopping:
+                if batch and not self._flush(batch) and not stopping:
+                    # InfluxDB is unreachable. Hold on to the batch and back off before trying again - new points
+                    # keep queueing up (and the oldest are dropped) in the meantime.
+                    self._stop_event.wait(min(self.flush_interval * 2, 30))
+                    batch = list(self._retry)
+                else:
+                    batch = []
+                deadline = monotonic() + self.flush_interval
+
+            if self.spool and self._connected and not stopping and monotonic() - self._last_replay >= self.replay_interval:
+                self._replay()
+
+    def _replay(self):
+        # Sends one chunk of spooled points. Chunks are rate limited so that a freshly restarted InfluxDB isn't flooded.
+        self._last_replay = monotonic()
+        if not self.spool.pending():
+            return
+        rejected = []
+
+        def write(chunk):
+            # A chunk that InfluxDB rejects (e.g. a field type conflict) would be rejected again on every retry, so it's
+            # dropped instead of holding up the rest of the spool.
+            try:
+                _write_grouped(chunk)
+            except InfluxDBClientError as e:
+                logger.warning(f"InfluxDB rejected {len(chunk)} spooled points. Dropping them. Reason: {e}")
+                rejected.append(len(chunk))
+
+        try:
+            replayed = self.spool.replay(write, self.replay_chunk_size)
+        except (ConnectionError, InfluxDBServerError) as e:
+            logger.info(f"Could not replay spooled points to InfluxDB ({type(e).__name__}). Will try again later.")
+            self._connected = False
+            return
+        self.points_dropped += sum(rejected)
+        self.points_replayed += replayed - sum(rejected)
+        if not self.spool.pending():
+            logger.info(f"... Finished replaying spooled points to InfluxDB ({self.points_replayed} points so far).")
+
+    def _flush(self, batch):
+        # Returns False if the batch should be retried.
+        start = monotonic()
+        try:
+            _write_grouped(batch)
+        except InfluxDBServerError as e:
+            logger.critical(f"Failed to write data to Influx. Reason: {e}")
+            self.batches_failed += 1
+            return True
+        except InfluxDBClientError as e:
+            # The request itself was rejected (e.g. a field type conflict or a missing database). Retrying would fail
+            # the same way, so the batch is dropped and the writer carries on.
+            logger.critical(f"InfluxDB rejected {len(batch)} points. Dropping them. Reason: {e}")
+            self.batches_failed += 1
+            self.points_dropped += len(batch)
+            self._retry = []
+            return True
+        except ConnectionError:
+            self.batches_failed += 1
+            self._connected = False
+            if self.spool:
+                logger.info(f"Connection to InfluxDB lost. Please investigate! Spooling {len(batch)} points to disk.")
+                self.spool.append(batch)
+                self.points_spooled += len(batch)
+                self._retry = []
+                return True
+            logger.info("Connection to InfluxDB lost. Please investigate! Points will be kept in memory and retried.")
+            # The retry batch holds at most batch_size points, and no more than fit under queue_size together with the
+            # points that are still queued. Like enqueue(), the oldest points are dropped first.
+            keep = max(0, min(self.batch_size, self._queue.maxsize - self._queue.qsize()))
+            if len(batch) > keep:
+                self.points_dropped += len(batch) - keep
+                batch = batch[len(batch) - keep:]
+            self._retry = batch
+            return False
+
+        latency = monotonic() - start
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.avg_latency = latency if not self.batches_written else 0.9 * self.avg_latency + 0.1 * latency
+        self.points_written += len(batch)
+        self.batches_written += 1
+        self._retry = []
+        self._connected = True
+        return True
+
+    def metrics(self):
+        return {
+            'queue_depth'       : self._queue.qsize() + len(self._retry),
+            'points_written'    : self.points_written,
+            'points_dropped'    : self.points_dropped,
+            'batches_written'   : self.batches_written,
+            'batches_failed'    : self.batches_failed,
+            'last_latency'      : self.last_latency,
+            'avg_latency'       : self.avg_latency,
+            'max_latency'       : self.max_latency,
+            'points_spooled'    : self.points_spooled,
+            'points_replayed'   : self.points_replayed,
+            'spool_bytes'       : self.spool.size() if self.spool else 0,
+        }
+
+    def stop(self, timeout=10):
+        # Flushes whatever is still queued, then stops the thread.
+        self._stop_event.set()
+        self.join(timeout)
+
+
+def _write_grouped(batch):
+    # batch is a list of (retention_policy, line) pairs, as queued by InfluxWriter.enqueue(). The lines are sent in one
+    # request per retention policy.
+    if not db_initialized and not init_db():
+        # The program was started while InfluxDB was unreachable, so the database may not exist yet.
+        raise ConnectionError(f"Could not connect to {db_settings['host']}:{db_settings['port']}")
+    groups = {}
+    for entry in batch:
+        if isinstance(entry, str):
+            # Spooled before points carried a retention policy
+            entry = (None, entry)
+        groups.setdefault(entry[0], []).append(entry[1])
+    for retention_policy, lines in groups.items():
+        client.write_points(lines, time_precision='ms', protocol='line', retention_policy=retention_policy)
+
+
+# The background writer. Started by start_writer(); when it isn't running, points are written synchronously.
+writer = None
+
+def start_writer():
+    global writer
+    if spool_settings['enabled']:
+        spool = Spool(spool_settings['directory'], spool_settings['segment_size'], spool_settings['max_size'])
+    else:
+        spool = None
+
+    writer = InfluxWriter(
+        batch_size=influx_writer_settings['batch_size'],
+        flush_interval=influx_writer_settings['flush_interval'],
+        queue_size=influx_writer_settings['queue_size'],
+        spool=spool,
+        replay_chunk_size=spool_settings['replay_chunk_size'],
+        replay_interval=spool_settings['replay_interval'],
+    )
+    writer.start()
+    return writer
+
+
+def write_points(points, retention_policy=None):
+    # Hands the points (line protocol strings - see LinePoint) to the background writer if it's running, otherwise writes them right away.
+    # retention_policy is the InfluxDB retention policy to write to (None for the database's default).
+    if writer:
+        writer.enqueue(points, retention_policy)
+        return
+
+    try:    
+        client.write_points(points, time_precision='ms', protocol='line', retention_policy=retention_policy)
+    except InfluxDBServerError as e:
+        logger.critical(f"Failed to write data to Influx. Reason: {e}")
+    except ConnectionError:
+        logger.info("Connection to InfluxDB lost. Please investigate!")
+        sys.exit()
+
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MS = timedelta(milliseconds=1)
+
+def to_ms(timestamp):
+    # Converts a naive UTC datetime (from datetime.utcnow()) to an integer millisecond timestamp.
+    return (timestamp - EPOCH) // ONE_MS
+
+
+def _escape_tag(value):
+    return str(value).replace(',', r'\,').replace(' ', r'\ ').replace('=', r'\=')
+
+
+class LinePoint():
+    '''
+    Compact replacement for Point + Point.to_dict() that serializes straight to InfluxDB line protocol.
+    The measurement, tags and field names are fixed when the LinePoint is created, so serializing a reading is a single
+    str.format() call:
+        LinePoint('raw_cts', ('current', 'power', 'pf'), {'ct' : 3}).line((1.2, 140.5, 0.98), 1620000000000)
+        -> 'raw_cts,ct=3 current=1.2,power=140.5,pf=0.98 1620000000000'
+    All field values are written as floats (no 'i' suffix), so a value that happens to be an int can't cause a field
+    type conflict.
+    '''
+    __slots__ = ('prefix', 'field_names', 'template')
+
+    def __init__(self, measurement, field_names, tags=None):
+        self.prefix = _escape_tag(measurement) + ''.join(f',{_escape_tag(k)}={_escape_tag(v)}' for k, v in sorted((tags or {}).items()))
+        self.field_names = tuple(field_names)
+        self.template = self.prefix + ' ' + ','.join(f'{name}={{}}' for name in self.field_names) + ' {}'
+
+    def line(self, values, timestamp):
+        # values are in field_names order. timestamp is in milliseconds - see to_ms().
+        return self.template.format(*values, timestamp)
+
+
+# Precomputed line protocol points for every series written by write_to_influx().
+HOME_LOAD_POINT = LinePoint('home_load', ('current', 'power'))
+SOLAR_POINT = LinePoint('solar', ('current', 'power', 'pf'))
+NET_POINTS = {status : LinePoint('net', ('current', 'power'), {'status' : status}) for status in ('Producing', 'Consuming', 'No data')}
+CT_POINTS = {name : LinePoint('raw_cts', ('current', 'power', 'pf'), {'ct' : name[2:]}) for name in ct_names}     # Tagged by CT number
+VOLTAGE_POINT = LinePoint('voltages', ('voltage',), {'v_input' : 0})
+LINE_FREQUENCY_POINT = LinePoint('line_frequency', ('frequency', 'cycles'))     # Only written when the windows are aligned to whole cycles
+
+# Wide-row schema: everything from one interval in a single point. See influx_schema in config.py.
+WIDE_POINT = LinePoint('readings',
+    ['home_load_current', 'home_load_power', 'solar_current', 'solar_power', 'solar_pf', 'net_current', 'net_power', 'voltage']
+    + [f'{name}_{field}' for name in ct_names for field in ('current', 'power', 'pf')])
+
+
+# True once init_db() has succeeded
+db_initialized = False
+
 def init_db():
+    global db_initialized
     try:
         client.create_database(db_settings['database'])
         logger.info("... DB initalized.")
+        db_initialized = True
         return True
     except ConnectionRefusedError:
         logger.debug("Could not connect to InfluxDB")
@@ -163,9 +450,14 @@ def init_db():
 
 
 def close_db():
+    global writer
+    if writer:
+        writer.stop()
+        writer = None
     client.close()
 
-def write_to_influx(solar_power_values, home_load_values, net_power_values, ct0_dict, ct1_dict, ct2_dict, ct3_dict, ct4_dict, ct5_dict, ct6_dict, ct7_dict, ct8_dict, ct9_dict, ct10_dict, ct11_dict, ct12_dict, ct13_dict, poll_time, length, voltages):
+def write_to_influx(solar_power_values, home_load_values, net_power_values, ct_values, poll_time, length, voltages):
+    # ct_values is a dictionary of CT name -> {'power' : [...], 'current' : [...], 'pf' : [...]}, with one entry for every CT in the channel table.
     
     # Calculate Averages
     avg_solar_power = sum(solar_power_values['power']) / length
@@ -175,100 +467,39 @@ def write_to_influx(solar_power_values, home_load_values, net_power_values, ct0_
     avg_home_current = sum(home_load_values['current']) / length
     avg_net_power = sum(net_power_values['power']) / length
     avg_net_current = sum(net_power_values['current']) / length
-    ct0_avg_power = sum(ct0_dict['power']) / length
-    ct0_avg_current = sum(ct0_dict['current']) / length
-    ct0_avg_pf = sum(ct0_dict['pf']) / length
-    ct1_avg_power = sum(ct1_dict['power']) / length
-    ct1_avg_current = sum(ct1_dict['current']) / length
-    ct1_avg_pf = sum(ct1_dict['pf']) / length
-    ct2_avg_power = sum(ct2_dict['power']) / length
-    ct2_avg_current = sum(ct2_dict['current']) / length
-    ct2_avg_pf = sum(ct2_dict['pf']) / length
-    ct3_avg_power = sum(ct3_dict['power']) / length
-    ct3_avg_current = sum(ct3_dict['current']) / length
-    ct3_avg_pf = sum(ct3_dict['pf']) / length
-    ct4_avg_power = sum(ct4_dict['power']) / length
-    ct4_avg_current = sum(ct4_dict['current']) / length
-    ct4_avg_pf = sum(ct4_dict['pf']) / length
-    ct5_avg_power = sum(ct5_dict['power']) / length
-    ct5_avg_current = sum(ct5_dict['current']) / length
-    ct5_avg_pf = sum(ct5_dict['pf']) / length
-    ct6_avg_power = sum(ct6_dict['power']) / length
-    ct6_avg_current = sum(ct6_dict['current']) / length
-    ct6_avg_pf = sum(ct6_dict['pf']) / length
-    ct7_avg_power = sum(ct7_dict['power']) / length
-    ct7_avg_current = sum(ct7_dict['current']) / length
-    ct7_avg_pf = sum(ct7_dict['pf']) / length
-    ct8_avg_power = sum(ct8_dict['power']) / length
-    ct8_avg_current = sum(ct8_dict['current']) / length
-    ct8_avg_pf = sum(ct8_dict['pf']) / length
-    ct9_avg_power = sum(ct9_dict['power']) / length
-    ct9_avg_current = sum(ct9_dict['current']) / length
-    ct9_avg_pf = sum(ct9_dict['pf']) / length
-    ct10_avg_power = sum(ct10_dict['power']) / length
-    ct10_avg_current = sum(ct10_dict['current']) / length
-    ct10_avg_pf = sum(ct10_dict['pf']) / length
-    ct11_avg_power = sum(ct11_dict['power']) / length
-    ct11_avg_current = sum(ct11_dict['current']) / length
-    ct11_avg_pf = sum(ct11_dict['pf']) / length
-    ct12_avg_power = sum(ct12_dict['power']) / length
-    ct12_avg_current = sum(ct12_dict['current']) / length
-    ct12_avg_pf = sum(ct12_dict['pf']) / length
-    ct13_avg_power = sum(ct13_dict['power']) / length
-    ct13_avg_current = sum(ct13_dict['current']) / length
-    ct13_avg_pf = sum(ct13_dict['pf']) / length
+    ct_averages = {}
+    for name in ct_names:
+        values = ct_values[name]
+        ct_averages[name] = (sum(values['current']) / length, sum(values['power']) / length, sum(values['pf']) / length)
     
     avg_voltage = sum(voltages) / length
 
-    # Create Points
-    home_load = Point('home_load', power=avg_home_power, current=avg_home_current, time=poll_time)
-    solar = Point('solar', power=avg_solar_power, current=avg_solar_current, pf=avg_solar_pf, time=poll_time)
-    net = Point('net', power=avg_net_power, current=avg_net_current, time=poll_time)
-    ct0 = Point('ct', power=ct0_avg_power, current=ct0_avg_current, pf=ct0_avg_pf, time=poll_time, num=0)
-    ct1 = Point('ct', power=ct1_avg_power, current=ct1_avg_current, pf=ct1_avg_pf, time=poll_time, num=1)
-    ct2 = Point('ct', power=ct2_avg_power, current=ct2_avg_current, pf=ct2_avg_pf, time=poll_time, num=2)
-    ct3 = Point('ct', power=ct3_avg_power, current=ct3_avg_current, pf=ct3_avg_pf, time=poll_time, num=3)
-    ct4 = Point('ct', power=ct4_avg_power, current=ct4_avg_current, pf=ct4_avg_pf, time=poll_time, num=4)
-    ct5 = Point('ct', power=ct5_avg_power, current=ct5_avg_current, pf=ct5_avg_pf, time=poll_time, num=5)
-    ct6 = Point('ct', power=ct6_avg_power, current=ct6_avg_current, pf=ct6_avg_pf, time=poll_time, num=6)
-    ct7 = Point('ct', power=ct7_avg_power, current=ct7_avg_current, pf=ct7_avg_pf, time=poll_time, num=7)
-    ct8 = Point('ct', power=ct8_avg_power, current=ct8_avg_current, pf=ct8_avg_pf, time=poll_time, num=8)
-    ct9 = Point('ct', power=ct9_avg_power, current=ct9_avg_current, pf=ct9_avg_pf, time=poll_time, num=9)
-    ct10 = Point('ct', power=ct10_avg_power, current=ct10_avg_current, pf=ct10_avg_pf, time=poll_time, num=10)
-    ct11 = Point('ct', power=ct11_avg_power, current=ct11_avg_current, pf=ct11_avg_pf, time=poll_time, num=11)
-    ct12 = Point('ct', power=ct12_avg_power, current=ct12_avg_current, pf=ct12_avg_pf, time=poll_time, num=12)
-    ct13 = Point('ct', power=ct13_avg_power, current=ct13_avg_current, pf=ct13_avg_pf, time=poll_time, num=13)
-
-    v = Point('voltage', voltage=avg_voltage, v_input=0, time=poll_time)
-
-    points = [
-        home_load.to_dict(),
-        solar.to_dict(),
-        net.to_dict(),
-        ct0.to_dict(),
-        ct1.to_dict(),
-        ct2.to_dict(),
-        ct3.to_dict(),
-        ct4.to_dict(),
-        ct5.to_dict(),
-        ct6.to_dict(),
-        ct7.to_dict(),
-        ct8.to_dict(),
-        ct9.to_dict(),
-        ct10.to_dict(),
-        ct11.to_dict(),
-        ct12.to_dict(),
-        ct13.to_dict(),
-        v.to_dict(),
-    ]
+    # Serialize straight to line protocol
+    timestamp = to_ms(poll_time)
+    if avg_net_power < 0:
+        status = 'Producing'
+    elif avg_net_power > 0:
+        status = 'Consuming'
+    else:
+        status = 'No data'
 
-    try:    
-        client.write_points(points, time_precision='ms')
-    except InfluxDBServerError as e:
-        logger.critical(f"Failed to write data to Influx. Reason: {e}")
-    except ConnectionError:
-        logger.info("Connection to InfluxDB lost. Please investigate!")
-        sys.exit()
+    points = []
+    if influx_schema in ('narrow', 'both'):
+        points += [
+            HOME_LOAD_POINT.line((avg_home_current, avg_home_power), timestamp),
+            SOLAR_POINT.line((avg_solar_current, avg_solar_power, avg_solar_pf), timestamp),
+            NET_POINTS[status].line((avg_net_current, avg_net_power), timestamp),
+        ]
+        points += [CT_POINTS[name].line(ct_averages[name], timestamp) for name in ct_names]
+        points.append(VOLTAGE_POINT.line((avg_voltage,), timestamp))
+
+    if influx_schema in ('wide', 'both'):
+        values = [avg_home_current, avg_home_power, avg_solar_current, avg_solar_power, avg_solar_pf, avg_net_current, avg_net_power, avg_voltage]
+        for name in ct_names:
+            values.extend(ct_averages[name])
+        points.append(WIDE_POINT.line(values, timestamp))
+
+    write_points(points)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+# This module contains the Prometheus endpoint used by power-monitor.py when metrics_settings['enabled'] is set.
+# The main loop publishes every reading as a new snapshot, which replaces the previous one in a single assignment.
+# Scrapes are served from a separate thread and only ever read the latest snapshot, so a scrape never holds up sampling
+# and never sees a half-updated reading.
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import channels, logger
+from influx_interface import EPOCH
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# (metric name, type, help text, results key) for the per-CT metrics
+CT_METRICS = (
+    ('power_monitor_ct_power_watts', 'gauge', 'Real power measured by the CT', 'power'),
+    ('power_monitor_ct_current_amps', 'gauge', 'RMS current measured by the CT', 'current'),
+    ('power_monitor_ct_power_factor', 'gauge', 'Power factor measured by the CT', 'pf'),
+)
+
+# (metric name, type, help text, totals key) for the aggregated values
+TOTAL_METRICS = (
+    ('power_monitor_home_load_watts', 'gauge', 'Total home consumption', 'home_load_power'),
+    ('power_monitor_home_load_amps', 'gauge', 'Total home consumption current', 'home_load_current'),
+    ('power_monitor_solar_watts', 'gauge', 'Solar production', 'solar_power'),
+    ('power_monitor_net_watts', 'gauge', 'Net power (negative while exporting)', 'net_power'),
+    ('power_monitor_net_amps', 'gauge', 'Net current (negative while exporting)', 'net_current'),
+    ('power_monitor_voltage_volts', 'gauge', 'RMS grid voltage', 'voltage'),
+    ('power_monitor_line_frequency_hertz', 'gauge', 'Grid frequency (only when the windows are aligned to whole cycles)', 'line_frequency'),
+)
+
+# (metric name, type, help text, stats key) for the values returned by the stats callable
+STAT_METRICS = (
+    ('power_monitor_windows_total', 'counter', 'Sample windows captured', 'windows'),
+    ('power_monitor_overruns_total', 'counter', 'Sample windows dropped because processing could not keep up', 'overruns'),
+    ('power_monitor_influx_queue_depth', 'gauge', 'Points waiting to be written to InfluxDB', 'queue_depth'),
+    ('power_monitor_influx_points_written_total', 'counter', 'Points written to InfluxDB', 'points_written'),
+    ('power_monitor_influx_points_dropped_total', 'counter', 'Points dropped because the InfluxDB queue was full', 'points_dropped'),
+    ('power_monitor_influx_points_spooled_total', 'counter', 'Points spooled to disk while InfluxDB was unreachable', 'points_spooled'),
+    ('power_monitor_board_voltage_volts', 'gauge', 'Smoothed board reference voltage', 'board_voltage'),
+    ('power_monitor_reference_alarms_total', 'counter', 'Sudden changes of the board reference voltage', 'reference_alarms'),
+)
+
+
+class MetricsServer():
+    '''
+    Serves the latest reading in the Prometheus text format on http://<host>:<port>/metrics.
+    host, port  : address to listen on
+    stats       : optional callable that returns a dictionary with any of the STAT_METRICS keys. It is called from the
+                  server thread on every scrape, so it must only read counters.
+    '''
+    def __init__(self, host='0.0.0.0', port=9110, stats=None):
+        self.stats = stats
+        self._snapshot = None
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"... Serving Prometheus metrics on http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def publish(self, poll_time, results, totals):
+        '''
+        Replaces the snapshot served to scrapes.
+        poll_time   : naive UTC datetime of the reading
+        results     : the results dictionary of the window (see calculate_power())
+        totals      : dictionary with the TOTAL_METRICS keys. Missing keys are left out of the page.
+        '''
+        self._snapshot = ((poll_time - EPOCH).total_seconds(), results, totals)
+
+    def render(self):
+        # Returns the metrics page for the current snapshot.
+        snapshot = self._snapshot
+        lines = []
+        if snapshot:
+            timestamp, results, totals = snapshot
+            cts = [name for name in results if name != 'voltage']
+            for metric, metric_type, description, key in CT_METRICS:
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {metric_type}']
+                for name in cts:
+                    lines.append(f'{metric}{{ct="{name[2:]}",role="{channels[name]["role"]}"}} {results[name][key]}')
+            for metric, metric_type, description, key in TOTAL_METRICS:
+                if key not in totals:
+                    continue
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {metric_type}', f'{metric} {totals[key]}']
+            lines += [
+                '# HELP power_monitor_last_reading_timestamp_seconds Time of the latest reading',
+                '# TYPE power_monitor_last_reading_timestamp_seconds gauge',
+                f'power_monitor_last_reading_timestamp_seconds {timestamp}',
+            ]
+
+        stats = self.stats() if self.stats else {}
+        for metric, metric_type, description, key in STAT_METRICS:
+            if key in stats:
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} {metric_type}', f'{metric} {stats[key]}']
+        return '\n'.join(lines) + '\n'
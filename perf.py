@@ -0,0 +1,153 @@
+# This module contains the self-monitoring used by power-monitor.py. Every stage of the main loop (reading the board
+# voltage, sampling, the power calculations, aggregation and the database writes) is timed with the monotonic clock,
+# and the timings are kept in a fixed-size histogram per stage. Every perf_settings['interval'] seconds, a summary is
+# written to the monitor_perf measurement and the histograms start over - so a slow SD card, network or regression
+# shows up in Grafana.
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import sqrt
+from time import perf_counter
+from prettytable import PrettyTable
+from influx_interface import LinePoint, to_ms
+
+# Upper bounds of the histogram buckets, in milliseconds. Anything slower goes in a final overflow bucket.
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class StageHistogram():
+    '''
+    Timings of one stage.
+    count / total / max : number of spans, their total and the longest, in seconds
+    buckets             : number of spans per BUCKETS entry, plus one overflow bucket
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect_left(BUCKETS, seconds * 1000)] += 1
+
+    def percentile(self, fraction):
+        # Returns the upper bound (in ms) of the bucket that holds the given fraction of the spans, capped at the longest span.
+        target = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return min(BUCKETS[i], self.max * 1000) if i < len(BUCKETS) else self.max * 1000
+        return 0
+
+
+class PerfMonitor():
+    '''
+    Collects the stage timings, the achieved sample rate and the jitter of the interval between windows.
+    interval    : seconds between monitor_perf points (see due())
+    measurement : InfluxDB measurement to write to
+
+    span(stage) is a context manager that times the code inside it. It can be used from several threads (e.g. the
+    acquisition thread) at once. cycle() is called once for every window that is processed.
+    '''
+    def __init__(self, interval=60, measurement='monitor_perf'):
+        self.interval = interval
+        self.measurement = measurement
+        self._lock = threading.Lock()
+        self._points = {}
+        self._last_cycle = None
+        self._reset(perf_counter())
+
+    def _reset(self, now):
+        self.stages = {}
+        self.started = now
+        self.cycles = 0
+        self.samples = 0
+        self._intervals = 0
+        self._interval_sum = 0
+        self._interval_sq_sum = 0
+        self._interval_max = 0
+
+    @contextmanager
+    def span(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, perf_counter() - start)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = StageHistogram()
+            histogram.add(seconds)
+
+    def cycle(self, num_samples):
+        # num_samples : total number of samples (over every channel) in the window that was just processed
+        now = perf_counter()
+        with self._lock:
+            if self._last_cycle is not None:
+                interval = now - self._last_cycle
+                self._intervals += 1
+                self._interval_sum += interval
+                self._interval_sq_sum += interval * interval
+                if interval > self._interval_max:
+                    self._interval_max = interval
+            self._last_cycle = now
+            self.cycles += 1
+            self.samples += num_samples
+
+    def due(self):
+        return perf_counter() - self.started >= self.interval
+
+    def summary(self):
+        # Returns a dictionary of field name -> value for the current period.
+        with self._lock:
+            elapsed = perf_counter() - self.started
+            intervals = self._intervals
+            fields = {
+                'cycles' : self.cycles,
+                'samples_per_second' : self.samples / elapsed if elapsed else 0,
+                'cycle_interval_ms' : 0,
+                'cycle_interval_max_ms' : self._interval_max * 1000,
+                'jitter_ms' : 0,
+            }
+            if intervals:
+                mean = self._interval_sum / intervals
+                variance = max(self._interval_sq_sum / intervals - mean * mean, 0)
+                fields['cycle_interval_ms'] = mean * 1000
+                fields['jitter_ms'] = sqrt(variance) * 1000       # Standard deviation of the interval between windows
+            for stage, histogram in sorted(self.stages.items()):
+                fields[f'{stage}_count'] = histogram.count
+                fields[f'{stage}_mean_ms'] = histogram.total / histogram.count * 1000
+                fields[f'{stage}_p50_ms'] = histogram.percentile(0.5)
+                fields[f'{stage}_p95_ms'] = histogram.percentile(0.95)
+                fields[f'{stage}_max_ms'] = histogram.max * 1000
+        return fields
+
+    def line(self, poll_time):
+        # Returns the monitor_perf line protocol point for the current period, and starts a new period.
+        fields = self.summary()
+        names = tuple(fields)
+        point = self._points.get(names)
+        if point is None:
+            point = self._points[names] = LinePoint(self.measurement, names)
+        with self._lock:
+            self._reset(perf_counter())
+        return point.line(fields.values(), to_ms(poll_time))
+
+    def table(self):
+        # Returns a table of the stage timings for the terminal output.
+        fields = self.summary()
+        stages = sorted(name[:-len('_count')] for name in fields if name.endswith('_count'))
+        t = PrettyTable(['Stage', 'Count', 'Mean ms', 'p50 ms', 'p95 ms', 'Max ms'])
+        for stage in stages:
+            t.add_row([stage] + [round(fields[f'{stage}_{field}'], 2) for field in ('count', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms')])
+        return (t.get_string() + f"\n{round(fields['samples_per_second'] / 1000, 1)} KSPS processed, {fields['cycles']} windows, "
+            f"interval {round(fields['cycle_interval_ms'], 1)} ms avg / {round(fields['cycle_interval_max_ms'], 1)} ms max, jitter {round(fields['jitter_ms'], 1)} ms")
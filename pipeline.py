@@ -0,0 +1,139 @@
+# This module contains the multi-process pipeline used by power-monitor.py when pipeline_settings['enabled'] is set.
+# Acquisition and the power calculations each run in their own process, and the main process is left with the output
+# stage (aggregation and the database writes), so the three stages can use separate cores instead of sharing one GIL.
+# Raw sample windows are passed between the processes through a ring of slots in a multiprocessing.shared_memory
+# block - only the slot number goes through a queue, the samples themselves are never copied or pickled.
+
+import os
+import signal
+import multiprocessing
+from multiprocessing import shared_memory
+from queue import Empty
+from config import logger
+from common import collect_data
+from buffers import SampleBuffer
+from dsp import channel_names
+
+
+def pin_to_cpu(cpu, stage):
+    # Pins the calling process to a single CPU. Does nothing if cpu is None.
+    if cpu is None:
+        return
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except (AttributeError, OSError) as e:
+        logger.info(f"Could not pin the {stage} stage to CPU {cpu}: {e}")
+
+
+class Pipeline():
+    '''
+    Runs acquisition and the power calculations in two child processes.
+    num_samples     : number of samples per window
+    read_reference  : callable that returns the current board voltage. Called in the acquisition process once per window.
+    calculate       : callable(samples, board_voltage) that returns the results dictionary. Called in the DSP process.
+    slots           : number of sample windows in the shared memory ring. If the DSP stage falls behind, the oldest
+                      window waiting for it is dropped and counted as an overrun.
+    cpus            : dictionary with the CPU number for the 'acquisition', 'dsp' and 'output' stages. None (or a missing
+                      key) leaves that stage unpinned. The output stage is the process that calls start().
+
+    windows         : total number of windows captured
+    overruns        : number of windows that were dropped because the DSP stage could not keep up
+
+    The child processes are forked, so they inherit the open SPI devices, the calibration and the calculate callable.
+    '''
+    def __init__(self, num_samples, read_reference, calculate, slots=4, cpus=None):
+        self.num_samples = num_samples
+        self.read_reference = read_reference
+        self.calculate = calculate
+        self.slots = slots
+        self.cpus = cpus or {}
+
+        context = multiprocessing.get_context('fork')
+        self._slot_size = 2 * len(channel_names) * num_samples
+        self._memory = shared_memory.SharedMemory(create=True, size=self._slot_size * slots)
+        self._free = context.Queue()
+        self._ready = context.Queue()
+        self._results = context.Queue(maxsize=slots)
+        self._stop_event = context.Event()
+        self._windows = context.Value('L', 0)
+        self._overruns = context.Value('L', 0)
+        for slot in range(slots):
+            self._free.put(slot)
+
+        self._processes = [
+            context.Process(target=self._acquire, name='acquisition', daemon=True),
+            context.Process(target=self._process, name='dsp', daemon=True),
+        ]
+
+    @property
+    def windows(self):
+        return self._windows.value
+
+    @property
+    def overruns(self):
+        return self._overruns.value
+
+    def _buffers(self):
+        # One SampleBuffer per slot, laid over this process' mapping of the shared memory block.
+        return [SampleBuffer(channel_names, self.num_samples, self._memory.buf[k * self._slot_size:(k + 1) * self._slot_size]) for k in range(self.slots)]
+
+    def _child_setup(self, stage):
+        # Ctrl-C is handled by the main process, which stops the children through stop().
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pin_to_cpu(self.cpus.get(stage), stage)
+
+    def _acquire(self):
+        self._child_setup('acquisition')
+        buffers = self._buffers()
+        while not self._stop_event.is_set():
+            try:
+                slot = self._free.get_nowait()
+            except Empty:
+                try:
+                    # Every slot is full - take back the oldest window that is still waiting for the DSP stage.
+                    slot = self._ready.get_nowait()[0]
+                    with self._overruns.get_lock():
+                        self._overruns.value += 1
+                except Empty:
+                    try:
+                        slot = self._free.get(timeout=1)
+                    except Empty:
+                        continue
+
+            board_voltage = self.read_reference()
+            samples = collect_data(self.num_samples, buffers[slot])
+            with self._windows.get_lock():
+                self._windows.value += 1
+            self._ready.put((slot, samples['time'], board_voltage))
+
+    def _process(self):
+        self._child_setup('dsp')
+        buffers = self._buffers()
+        while not self._stop_event.is_set():
+            try:
+                slot, poll_time, board_voltage = self._ready.get(timeout=1)
+            except Empty:
+                continue
+            buffer = buffers[slot]
+            buffer.time = poll_time
+            results = self.calculate(buffer.as_samples(), board_voltage)
+            self._free.put(slot)
+            self._results.put((poll_time, results))
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        pin_to_cpu(self.cpus.get('output'), 'output')
+
+    def get(self, timeout=None):
+        # Returns (poll_time, results) for the next processed window. Blocks until one is available.
+        return self._results.get(timeout=timeout)
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._memory.close()
+        self._memory.unlink()
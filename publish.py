@@ -0,0 +1,223 @@
+# This module contains the live stream used by power-monitor.py when publish_settings['enabled'] is set.
+# Every window's results are pushed to the subscribers as soon as they are calculated - over a Unix socket, and
+# optionally over a WebSocket for browsers - so live displays and local automation don't have to poll InfluxDB.
+#
+# Each subscriber has its own bounded buffer and sending thread. If a subscriber can't keep up, the oldest frames in its
+# buffer are dropped; publish() itself never waits for a subscriber.
+#
+# Frames are JSON objects (or msgpack maps) like:
+#   {"time": 1620000000000, "voltage": 121.5, "cts": {"ct0": {"power": 1520.2, "current": 12.7, "pf": 0.98}, ...}}
+# On the Unix socket, JSON frames are separated by newlines and msgpack frames are written back to back. On the
+# WebSocket, every frame is one message (text for JSON, binary for msgpack).
+
+import os
+import json
+import socket
+import base64
+import hashlib
+import struct
+import threading
+from collections import deque
+from config import logger
+from influx_interface import to_ms
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def select_encoding(requested):
+    # Returns the encoding to use. msgpack is optional - fall back to JSON if it isn't installed.
+    if requested == 'msgpack':
+        if msgpack is not None:
+            return 'msgpack'
+        logger.info("msgpack is not installed (pip3 install msgpack) - publishing JSON instead.")
+    return 'json'
+
+
+def websocket_header(payload, binary):
+    # Header of a single unmasked, unfragmented server-to-client WebSocket frame.
+    opcode = 0x82 if binary else 0x81
+    length = len(payload)
+    if length < 126:
+        return struct.pack('!BB', opcode, length)
+    if length < 65536:
+        return struct.pack('!BBH', opcode, 126, length)
+    return struct.pack('!BBQ', opcode, 127, length)
+
+
+def websocket_handshake(sock):
+    # Reads the client's opening handshake and sends the response. Returns False if it isn't a WebSocket request.
+    request = b''
+    while b'\r\n\r\n' not in request:
+        data = sock.recv(1024)
+        if not data or len(request) > 8192:
+            return False
+        request += data
+    key = None
+    for line in request.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'sec-websocket-key':
+            key = value.strip()
+    if key is None:
+        sock.sendall(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+        return False
+    accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+    sock.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+    return True
+
+
+class Subscriber():
+    '''
+    One connected client.
+    sock        : the connected socket
+    wrap        : callable that turns an encoded frame into the bytes to send
+    buffer_size : number of frames that can wait to be sent. When the buffer is full, the oldest frame is dropped.
+    handshake   : optional callable(sock) run by the sending thread before the first frame. Returning False drops the client.
+    '''
+    def __init__(self, sock, wrap, buffer_size, handshake=None):
+        self.sock = sock
+        self.wrap = wrap
+        self.handshake = handshake
+        self.frames = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def push(self, frame):
+        with self._ready:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self._ready.notify()
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+    def run(self):
+        try:
+            if self.handshake and not self.handshake(self.sock):
+                return
+            while True:
+                with self._ready:
+                    while not self.frames and not self.closed:
+                        self._ready.wait()
+                    if self.closed:
+                        return
+                    frame = self.frames.popleft()
+                self.sock.sendall(self.wrap(frame))
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.sock.close()
+
+
+class Publisher():
+    '''
+    Pushes the results of every window to the connected subscribers.
+    unix_socket     : path of the Unix socket to listen on, or None
+    websocket_port  : TCP port to accept WebSocket clients on, or None
+    websocket_host  : address the WebSocket listens on
+    encoding        : 'json' or 'msgpack' (falls back to 'json' if msgpack isn't installed)
+    buffer_size     : frames buffered per subscriber before the oldest are dropped
+
+    dropped         : total number of frames dropped for slow subscribers
+    '''
+    def __init__(self, unix_socket=None, websocket_port=None, websocket_host='0.0.0.0', encoding='json', buffer_size=100):
+        self.unix_socket = unix_socket
+        self.websocket_port = websocket_port
+        self.websocket_host = websocket_host
+        self.encoding = select_encoding(encoding)
+        self.buffer_size = buffer_size
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._dropped = 0
+
+        if self.encoding == 'msgpack':
+            self._encode = msgpack.packb
+            self._unix_wrap = lambda frame: frame
+        else:
+            self._encode = lambda data: json.dumps(data, separators=(',', ':')).encode('utf-8')
+            self._unix_wrap = lambda frame: frame + b'\n'
+        binary = self.encoding == 'msgpack'
+        self._websocket_wrap = lambda frame: websocket_header(frame, binary) + frame
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    @property
+    def dropped(self):
+        with self._lock:
+            return self._dropped + sum(subscriber.dropped for subscriber in self._subscribers)
+
+    def start(self):
+        if self.unix_socket:
+            os.makedirs(os.path.dirname(self.unix_socket) or '.', exist_ok=True)
+            if os.path.exists(self.unix_socket):
+                os.remove(self.unix_socket)     # Left over from a previous run
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(self.unix_socket)
+            listener.listen()
+            self._listen(listener, self._unix_wrap, None)
+            logger.info(f"... Publishing live readings on {self.unix_socket}")
+
+        if self.websocket_port:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.websocket_host, self.websocket_port))
+            listener.listen()
+            self._listen(listener, self._websocket_wrap, websocket_handshake)
+            logger.info(f"... Publishing live readings on ws://{self.websocket_host}:{self.websocket_port}/")
+
+    def _listen(self, listener, wrap, handshake):
+        self._listeners.append(listener)
+        threading.Thread(target=self._accept, args=(listener, wrap, handshake), name='publish-accept', daemon=True).start()
+
+    def _accept(self, listener, wrap, handshake):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return          # The listener was closed by stop()
+            subscriber = Subscriber(sock, wrap, self.buffer_size, handshake)
+            with self._lock:
+                self._subscribers.append(subscriber)
+            threading.Thread(target=subscriber.run, name='publish', daemon=True).start()
+
+    def publish(self, poll_time, results):
+        # Encodes the results of a window once and queues the frame for every subscriber.
+        with self._lock:
+            subscribers = self._subscribers
+            if not subscribers:
+                return
+            closed = [subscriber for subscriber in subscribers if subscriber.closed]
+            if closed:
+                self._dropped += sum(subscriber.dropped for subscriber in closed)
+                subscribers = self._subscribers = [subscriber for subscriber in subscribers if not subscriber.closed]
+
+        cts = {name : {'power' : result['power'], 'current' : result['current'], 'pf' : result['pf']} for name, result in results.items() if name != 'voltage'}
+        frame = self._encode({'time' : to_ms(poll_time), 'voltage' : results['voltage'], 'cts' : cts})
+        for subscriber in subscribers:
+            subscriber.push(frame)
+
+    def stop(self):
+        for listener in self._listeners:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)     # Wakes up the accept() in _accept()
+            except OSError:
+                pass
+            listener.close()
+        with self._lock:
+            for subscriber in self._subscribers:
+                subscriber.close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
@@ -0,0 +1,77 @@
+# This module contains the tracker for the +3.3V board reference that every reading is scaled by.
+# The rail barely moves, so instead of reading it in a separate burst before every window, the board_voltage channel is
+# sampled along with the other channels in one window every reference_settings['refresh_interval'] seconds (see the
+# reference argument of collect_data() in common.py), and the readings are smoothed with an exponential moving average.
+# A reading that jumps away from the average is logged as a warning - a sagging 3.3V rail skews every result.
+
+import threading
+from time import monotonic
+from config import logger
+
+
+def board_voltage_from_reading(reading):
+    # Converts an average 10-bit reading of the board_voltage channel to volts. The rail is measured through a 1/2 divider.
+    return (reading / 1024) * 3.31 * 2
+
+
+class BoardReference():
+    '''
+    Keeps a smoothed value of the board reference voltage.
+    read_burst          : callable that returns the board voltage from a burst of dedicated readings. Used when no window
+                          has refreshed the value for refresh_interval seconds (e.g. at startup and in the calibration modes).
+    refresh_interval    : seconds between windows that sample the board_voltage channel. 0 samples it in every window.
+    smoothing           : weight of every new reading in the moving average, between 0 and 1
+    drift_alarm         : a reading that differs from the average by more than this many volts is logged as a warning
+
+    value               : the smoothed board voltage, or None before the first reading
+    refreshes           : number of readings folded into the average
+    alarms              : number of readings that raised the drift alarm
+
+    due() and update() are called from the acquisition side, once per window. value can be read from any thread.
+    '''
+    def __init__(self, read_burst, refresh_interval=10, smoothing=0.2, drift_alarm=0.1):
+        self.read_burst = read_burst
+        self.refresh_interval = refresh_interval
+        self.smoothing = smoothing
+        self.drift_alarm = drift_alarm
+        self.value = None
+        self.refreshes = 0
+        self.alarms = 0
+        self._lock = threading.Lock()
+        self._last_refresh = None
+
+    def due(self):
+        # True if the next window should sample the board_voltage channel.
+        return self._last_refresh is None or monotonic() - self._last_refresh >= self.refresh_interval
+
+    def add(self, board_voltage):
+        # Folds a new reading (in volts) into the average, and returns the new average.
+        with self._lock:
+            self._last_refresh = monotonic()
+            self.refreshes += 1
+            if self.value is None:
+                self.value = board_voltage
+                return self.value
+            if abs(board_voltage - self.value) > self.drift_alarm:
+                self.alarms += 1
+                logger.warning(f"The board reference voltage moved from {round(self.value, 3)}V to {round(board_voltage, 3)}V. Check the Pi's power supply.")
+            self.value += self.smoothing * (board_voltage - self.value)
+            return self.value
+
+    def update(self, samples):
+        '''
+        Returns the board voltage to use for a window returned by collect_data() / collect_cycles() / collect_sums().
+        If the window sampled the board_voltage channel, its average reading (the 'reference' key) is folded in first.
+        Otherwise the current value is returned as is - the next window that due() asks for will refresh it.
+        '''
+        if samples.get('reference') is not None:
+            return self.add(board_voltage_from_reading(samples['reference']))
+        if self.value is None:
+            return self.read()
+        return self.value
+
+    def read(self):
+        # Returns the smoothed board voltage, refreshing it with a burst of readings if it is out of date.
+        if self.due():
+            return self.add(self.read_burst())
+        return self.value
@@ -0,0 +1,194 @@
+# This module contains the capture file formats used by the 'record' and 'replay' modes of power-monitor.py.
+# A replay feeds stored sample windows through the same calculations, aggregation and database writes as live
+# sampling, as fast as the CPU allows - to reproduce problems seen in the field, or to load test the InfluxDB path.
+#
+# Three formats can be replayed:
+#   .pkl    : the last-debug.pkl file saved by debug mode (a single window)
+#   .csv    : a file written by dump_data() (a single window)
+#   .pmcap  : the binary format written by the 'record' mode - any number of windows, with the time and board voltage of each
+#
+# The .pmcap format is a header followed by the windows:
+#   header  : MAGIC, then '<HI' (number of channels, samples per channel), then '<H' + the channel names as UTF-8, joined with newlines
+#   window  : '<dd' (poll time in seconds since the epoch, board voltage), then the samples as little-endian unsigned shorts,
+#             channel-major - the same layout as SampleBuffer.data
+
+import csv
+import os
+import pickle
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+from time import perf_counter
+from buffers import SampleBuffer
+from dsp import channel_names
+from influx_interface import EPOCH
+
+MAGIC = b'PMCAP\x01'
+HEADER = struct.Struct('<HI')
+NAMES_LENGTH = struct.Struct('<H')
+WINDOW = struct.Struct('<dd')
+
+# Board voltage used for the .pkl and .csv formats, which don't store it. Matches a reading of ~510 on the +3.3V rail.
+NOMINAL_BOARD_VOLTAGE = 3.3
+
+
+class CaptureWriter():
+    '''
+    Writes sample windows to a .pmcap file.
+    path        : file to create
+    channels    : channel names of the SampleBuffers that will be written
+    num_samples : samples per channel in every window
+    '''
+    def __init__(self, path, channels, num_samples):
+        self.channels = list(channels)
+        self.num_samples = num_samples
+        self.windows = 0
+        self.file = open(path, 'wb')
+        names = '\n'.join(self.channels).encode('utf-8')
+        self.file.write(MAGIC + HEADER.pack(len(self.channels), num_samples) + NAMES_LENGTH.pack(len(names)) + names)
+
+    def write(self, buffer, board_voltage):
+        # buffer : a SampleBuffer with the same channels and number of samples as this file
+        data = buffer.data
+        if sys.byteorder != 'little':
+            data = array('H', data)
+            data.byteswap()
+        self.file.write(WINDOW.pack((buffer.time - EPOCH).total_seconds(), board_voltage))
+        self.file.write(data)
+        self.windows += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_pmcap(path):
+    # Yields (poll_time, board_voltage, SampleBuffer) for every window in a .pmcap file. The same buffer is reused for every window.
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file written by the 'record' mode.")
+        num_channels, num_samples = HEADER.unpack(f.read(HEADER.size))
+        names_length, = NAMES_LENGTH.unpack(f.read(NAMES_LENGTH.size))
+        channels = f.read(names_length).decode('utf-8').split('\n')
+        if len(channels) != num_channels:
+            raise ValueError(f"{path} has a corrupt header.")
+
+        buffer = SampleBuffer(channels, num_samples)
+        window_size = 2 * num_channels * num_samples
+        while True:
+            header = f.read(WINDOW.size)
+            if len(header) < WINDOW.size:
+                return
+            timestamp, board_voltage = WINDOW.unpack(header)
+            if f.readinto(buffer.data) < window_size:
+                return          # The last window was cut short, e.g. the recording was interrupted.
+            if sys.byteorder != 'little':
+                buffer.data.byteswap()
+            yield EPOCH + timedelta(seconds=timestamp), board_voltage, buffer
+
+
+def read_pickle(path):
+    # Yields the window saved by debug mode. Older versions pickled the samples dictionary (lists keyed by channel name)
+    # instead of the SampleBuffer.
+    with open(path, 'rb') as f:
+        samples = pickle.load(f)
+    if isinstance(samples, SampleBuffer):
+        yield samples.time, NOMINAL_BOARD_VOLTAGE, samples
+        return
+    channels = [name for name in samples if name != 'time']
+    buffer = SampleBuffer(channels, len(samples[channels[0]]))
+    for name in channels:
+        buffer.channel(name)[:] = array('H', samples[name])
+    yield samples.get('time'), NOMINAL_BOARD_VOLTAGE, buffer
+
+
+def read_csv(path):
+    # Yields the window in a file written by dump_data().
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    channels = rows[0][1:]
+    buffer = SampleBuffer(channels, len(rows) - 1)
+    for k, name in enumerate(channels, start=1):
+        view = buffer.channel(name)
+        for i, row in enumerate(rows[1:]):
+            view[i] = int(row[k])
+    yield None, NOMINAL_BOARD_VOLTAGE, buffer
+
+
+READERS = {
+    '.pmcap' : read_pmcap,
+    '.pkl' : read_pickle,
+    '.csv' : read_csv,
+}
+
+
+class ReplaySource():
+    '''
+    Iterates over the windows of a capture file, in the format returned by collect_data() plus the 'board_voltage' key
+    that AcquisitionWorker adds.
+    path        : a .pmcap, .pkl or .csv file
+    repeat      : number of passes over the file
+    interval    : seconds between windows, used for the poll times of files that don't store them. Recorded poll times are
+                  kept, and shifted forward on every pass after the first so that no two windows get the same time.
+
+    windows     : number of windows replayed so far
+    report()    : returns a summary of the replay speed
+    '''
+    def __init__(self, path, repeat=1, interval=0.5):
+        for extension, reader in READERS.items():
+            if path.endswith(extension):
+                self.reader = reader
+                break
+        else:
+            raise ValueError(f"Don't know how to replay {path}. Supported formats: {', '.join(READERS)}")
+        os.stat(path)       # Raises FileNotFoundError now rather than once the replay has started
+        self.path = path
+        self.repeat = repeat
+        self.interval = interval
+        self.windows = 0
+        self.samples = 0
+        self.start = None
+        self.first_time = None
+        self.last_time = None
+        self._iterator = self._windows()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def _windows(self):
+        self.start = perf_counter()
+        next_time = datetime.utcnow()
+        for _ in range(self.repeat):
+            offset = None
+            for poll_time, board_voltage, buffer in self.reader(self.path):
+                missing = [name for name in channel_names if name not in buffer.channels]
+                if missing:
+                    raise ValueError(f"{self.path} has no samples for {', '.join(missing)}. Captures can only be replayed with the channels they were recorded with enabled.")
+
+                # Poll times: recorded times are shifted to follow on from the previous pass, missing ones are synthesized.
+                if poll_time is None:
+                    poll_time = next_time
+                else:
+                    if offset is None:
+                        offset = max(next_time - poll_time, timedelta(0)) if self.windows else timedelta(0)
+                    poll_time += offset
+                next_time = poll_time + timedelta(seconds=self.interval)
+
+                buffer.time = poll_time
+                samples = buffer.as_samples()
+                samples['board_voltage'] = board_voltage
+                self.windows += 1
+                self.samples += buffer.num_samples * len(buffer.channels)
+                self.first_time = self.first_time or poll_time
+                self.last_time = poll_time
+                yield samples
+
+    def report(self):
+        elapsed = perf_counter() - self.start
+        covered = (self.last_time - self.first_time).total_seconds() + self.interval if self.windows else 0
+        return (f"Replayed {self.windows} windows ({self.samples} samples) from {self.path} in {round(elapsed, 2)} s: "
+            f"{round(self.windows / elapsed, 1)} cycles/s, {round(self.samples / elapsed / 1000, 1)} KSPS, "
+            f"{round(covered / elapsed, 1)}x real time")
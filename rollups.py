@@ -0,0 +1,121 @@
+# This module contains the on-device aggregation engine used by power-monitor.py.
+# Every reading is folded into a set of rollup windows (for example 1 second, 1 minute and 15 minutes) that are aligned
+# to wall-clock boundaries. When a window closes, a single point with the mean, min, max and energy of every field is
+# written to that window's measurement, so long-range dashboards don't have to scan the raw points.
+
+from influx_interface import LinePoint, EPOCH
+
+
+class RollupWindow():
+    '''
+    Incremental statistics for one rollup resolution.
+    interval            : window length in seconds. Windows start on multiples of the interval (in UTC).
+    measurement         : InfluxDB measurement the rolled-up points are written to
+    retention_policy    : InfluxDB retention policy to write to (None for the database's default)
+    fields              : names of the values passed to add(). For every field, <field>_mean, <field>_min and <field>_max are
+                          written. Fields ending in 'power' also get an energy total in Wh: ct0_power -> ct0_energy_wh.
+    '''
+    def __init__(self, interval, measurement, fields, retention_policy=None):
+        self.interval = interval
+        self.measurement = measurement
+        self.retention_policy = retention_policy
+        self.fields = list(fields)
+        self.power_fields = [i for i, name in enumerate(self.fields) if name.endswith('power')]
+
+        output_fields = ['readings', 'duration']
+        for name in self.fields:
+            output_fields += [f'{name}_mean', f'{name}_min', f'{name}_max']
+        for i in self.power_fields:
+            output_fields.append(self.fields[i][:-len('power')] + 'energy_wh')
+        self.point = LinePoint(measurement, output_fields)
+
+        self.window_start = None
+        self._reset()
+
+    def _reset(self):
+        num_fields = len(self.fields)
+        self.count = 0
+        self.duration = 0
+        self.sums = [0] * num_fields
+        self.mins = [None] * num_fields
+        self.maxs = [None] * num_fields
+        self.energy = [0] * len(self.power_fields)
+
+    def add(self, timestamp, values, duration):
+        '''
+        timestamp   : seconds since the epoch (UTC) of the reading
+        values      : list of values, in the same order as fields
+        duration    : number of seconds this reading represents, used for the energy totals
+
+        Returns the line protocol string for the previous window if this reading starts a new one, otherwise None.
+        '''
+        window_start = timestamp // self.interval * self.interval
+        line = None
+        if window_start != self.window_start:
+            if self.count:
+                line = self.close()
+            self.window_start = window_start
+
+        self.count += 1
+        self.duration += duration
+        sums, mins, maxs = self.sums, self.mins, self.maxs
+        for i, value in enumerate(values):
+            sums[i] += value
+            if mins[i] is None or value < mins[i]:
+                mins[i] = value
+            if maxs[i] is None or value > maxs[i]:
+                maxs[i] = value
+        for j, i in enumerate(self.power_fields):
+            self.energy[j] += values[i] * duration / 3600
+
+        return line
+
+    def close(self):
+        # Returns the line protocol string for the current window and starts a new, empty one.
+        values = [self.count, self.duration]
+        for i in range(len(self.fields)):
+            values += [self.sums[i] / self.count, self.mins[i], self.maxs[i]]
+        values += self.energy
+
+        line = self.point.line(values, int(self.window_start * 1000))
+        self._reset()
+        return line
+
+
+class RollupEngine():
+    '''
+    Feeds every reading to each configured RollupWindow.
+    windows     : list of dictionaries with 'interval', 'measurement' and (optionally) 'retention_policy' keys - see rollup_settings in config.py
+    fields      : names of the values passed to add()
+    max_gap     : a reading that arrives more than this many seconds after the previous one doesn't count the gap towards the
+                  energy totals, since nothing is known about the power during the gap.
+    '''
+    def __init__(self, windows, fields, max_gap=5):
+        self.fields = list(fields)
+        self.max_gap = max_gap
+        self.windows = [RollupWindow(w['interval'], w['measurement'], self.fields, w.get('retention_policy')) for w in windows]
+        self._last_timestamp = None
+
+    def add(self, poll_time, values):
+        '''
+        poll_time   : naive UTC datetime of the reading (the 'time' value from collect_data())
+        values      : dictionary of field name -> value. Must contain every field.
+
+        Returns a list of (retention_policy, line) tuples for every window that closed.
+        '''
+        timestamp = (poll_time - EPOCH).total_seconds()
+        if self._last_timestamp is None:
+            duration = 0
+        else:
+            duration = timestamp - self._last_timestamp
+            if duration < 0 or duration > self.max_gap:
+                duration = 0
+        self._last_timestamp = timestamp
+
+        ordered = [values[name] for name in self.fields]
+        closed = []
+        for window in self.windows:
+            line = window.add(timestamp, ordered, duration)
+            if line:
+                closed.append((window.retention_policy, line))
+        return closed
@@ -0,0 +1,134 @@
+# This module contains the adaptive sampling scheduler used by power-monitor.py when scheduler_settings['enabled'] is set.
+# Branch circuits often draw nothing for hours, but every CT is normally sampled in every window. The scheduler keeps
+# track of the RMS current of every CT and leaves CTs that have been idle for a while out of most windows, so the busy
+# CTs (and the voltage channel) are sampled at a higher rate. Before each window, the idle CTs are given a short probe
+# scan, and any CT that is no longer flat is sampled again right away.
+
+import threading
+from common import build_scans, collect_data, collect_sums, collect_cycles
+from config import channels
+from dsp import ct_names
+
+
+class AdaptiveScheduler():
+    '''
+    Chooses which CTs to sample in each window.
+    names           : the CTs to schedule. Defaults to every enabled CT.
+    idle_current    : a CT whose RMS current (A) stays below this is considered idle
+    idle_after      : number of consecutive windows below idle_current before a CT is left out
+    idle_every      : idle CTs are still sampled in every idle_every-th window, so their readings stay current
+    always_on       : CTs with these roles (see the channel table in config.py) are sampled in every window
+    probe_samples   : number of readings of the idle CTs taken before each window
+    probe_threshold : an idle CT is sampled again as soon as the spread of its probe readings (in ADC counts) exceeds this
+
+    skipped         : total number of CT windows that were left out
+    promotions      : number of times an idle CT was sampled again because its probe readings changed
+
+    collect() is called from the acquisition side and update() from the processing side - they may be different threads.
+    '''
+    def __init__(self, names=None, idle_current=0.5, idle_after=5, idle_every=10, always_on=('main', 'solar'), probe_samples=32, probe_threshold=8):
+        self.names = list(names or ct_names)
+        self.idle_current = idle_current
+        self.idle_after = idle_after
+        self.idle_every = idle_every
+        self.always_on = set(name for name in self.names if channels[name]['role'] in always_on)
+        self.probe_samples = probe_samples
+        self.probe_threshold = probe_threshold
+        self.skipped = 0
+        self.promotions = 0
+
+        self._lock = threading.Lock()
+        self._idle = set()
+        self._quiet_windows = {name: 0 for name in self.names}
+        self._last_results = {}
+        self._scan_lists = {}
+        self._window = 0
+
+    @property
+    def idle(self):
+        # The CTs that are currently idle, in ct_names order.
+        with self._lock:
+            return [name for name in self.names if name in self._idle]
+
+    def _scan_list(self, names, voltage=True):
+        # Scans are built once for each combination of channels and then reused.
+        # voltage : include the voltage channel. The probe scans leave it out.
+        key = (frozenset(names), voltage)
+        if key not in self._scan_lists:
+            self._scan_lists[key] = build_scans(list(names) + ['voltage'] if voltage else list(names))
+        return self._scan_lists[key]
+
+    def _probe(self, idle):
+        # Takes a short burst of readings of the idle CTs and returns the ones whose readings are no longer flat.
+        # The probe scans only hold the idle CTs, so every reading maps to the name at the same position.
+        scan_list = self._scan_list(idle, voltage=False)
+        lows = {}
+        highs = {}
+        for _ in range(self.probe_samples):
+            for scan, names in scan_list:
+                for name, value in zip(names, scan.read()):
+                    if name not in lows or value < lows[name]:
+                        lows[name] = value
+                    if name not in highs or value > highs[name]:
+                        highs[name] = value
+        return [name for name in idle if highs[name] - lows[name] > self.probe_threshold]
+
+    def _plan(self):
+        # Returns the CTs to sample in the next window.
+        with self._lock:
+            idle = [name for name in self.names if name in self._idle]
+        if idle and self._window % self.idle_every:
+            for name in self._probe(idle):
+                self._wake(name)
+                self.promotions += 1
+            with self._lock:
+                active = [name for name in self.names if name not in self._idle]
+        else:
+            active = list(self.names)
+
+        if not active:
+            # There must be at least one CT in every window for the voltage results.
+            active = self.names[:1]
+        self.skipped += len(self.names) - len(active)
+        self._window += 1
+        return active
+
+    def _wake(self, name):
+        with self._lock:
+            self._idle.discard(name)
+            self._quiet_windows[name] = 0
+
+    def collect(self, num_samples, buffer=None, streaming=False, aligned=False, reference=False):
+        '''
+        Drop-in replacement for collect_data() / collect_sums() / collect_cycles() that only samples the CTs chosen for this window.
+        The CTs that were left out are missing from the returned dictionary - update() fills them in afterwards.
+        '''
+        scan_list = self._scan_list(self._plan())
+        if streaming:
+            return collect_sums(num_samples, scan_list=scan_list, reference=reference)
+        if aligned:
+            return collect_cycles(num_samples, buffer, scan_list=scan_list, reference=reference)
+        return collect_data(num_samples, buffer, scan_list=scan_list, reference=reference)
+
+    def update(self, results):
+        '''
+        Updates the idle state of every CT from the results of a window, and adds the last known results for every CT
+        that was left out of the window (zeros for a CT that hasn't been sampled yet).
+        '''
+        with self._lock:
+            for name in self.names:
+                if name not in results:
+                    results[name] = dict(self._last_results.get(name) or {'type' : 'consumption', 'power' : 0, 'current' : 0, 'voltage' : results['voltage'], 'pf' : 0})
+                    continue
+
+                self._last_results[name] = results[name]
+                if name in self.always_on:
+                    continue
+                if results[name]['current'] < self.idle_current:
+                    self._quiet_windows[name] += 1
+                    if self._quiet_windows[name] >= self.idle_after:
+                        self._idle.add(name)
+                else:
+                    self._quiet_windows[name] = 0
+                    self._idle.discard(name)
+        return results
@@ -0,0 +1,106 @@
+# This module contains the on-disk spool used by the InfluxDB writer (see influx_interface.py).
+# When InfluxDB can't be reached, batches of points are appended to segment files on disk instead of being lost, and
+# they are replayed in rate-limited chunks once the database is back.
+
+import os
+import json
+from config import logger
+
+
+class Spool():
+    '''
+    Append-only, segmented spool of point batches.
+
+    directory       : where the segment files are kept. Anything left over from a previous run is replayed.
+    segment_size    : a new segment file is started once the current one reaches this many bytes
+    max_size        : total size cap in bytes. When it is exceeded, the oldest segments are deleted first.
+
+    Each line in a segment file is one JSON encoded batch (a list of [retention_policy, line] pairs). The spool is not thread safe - it is only
+    used from the writer thread.
+    '''
+    def __init__(self, directory, segment_size=1000000, max_size=100000000):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.evicted_segments = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = sorted(f for f in os.listdir(directory) if f.startswith('segment-') and f.endswith('.jsonl'))
+        self._next_number = int(self._segments[-1][8:-6]) + 1 if self._segments else 1
+        self._active = None             # Segment currently being appended to
+        self._replay_lines = None       # Batches from the segment being replayed
+        self._replay_position = 0
+
+        if self._segments:
+            logger.info(f"... Found {len(self._segments)} spooled segment(s) in {directory} - they will be written to InfluxDB once it is reachable.")
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def size(self):
+        return sum(os.path.getsize(self._path(segment)) for segment in self._segments)
+
+    def pending(self):
+        return bool(self._segments)
+
+    def append(self, points):
+        if self._active is None or os.path.getsize(self._path(self._active)) >= self.segment_size:
+            self._active = f'segment-{self._next_number:06d}.jsonl'
+            self._next_number += 1
+            self._segments.append(self._active)
+
+        with open(self._path(self._active), 'a') as f:
+            f.write(json.dumps(points) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._evict()
+
+    def _evict(self):
+        # Drop the oldest segments until the spool fits under max_size again. The active segment is never evicted.
+        while len(self._segments) > 1 and self.size() > self.max_size:
+            oldest = self._segments.pop(0)
+            os.remove(self._path(oldest))
+            self._replay_lines = None
+            self.evicted_segments += 1
+            logger.info(f"Spool is over its {self.max_size} byte limit - deleted the oldest segment ({oldest}).")
+
+    def replay(self, write, chunk_size):
+        '''
+        Writes the next chunk of spooled points using write(points). Batches are taken oldest first until the chunk holds
+        at least chunk_size points. write() should raise if the points couldn't be written, in which case they stay in
+        the spool. A segment is deleted once all of its points have been written. Re-sending points after a crash is
+        harmless, since InfluxDB overwrites identical points.
+        Returns the number of points written.
+        '''
+        if not self._segments:
+            return 0
+
+        if self._replay_lines is None:
+            oldest = self._segments[0]
+            if oldest == self._active:
+                # Stop appending to this segment so it can be replayed.
+                self._active = None
+            with open(self._path(oldest)) as f:
+                self._replay_lines = f.readlines()
+            self._replay_position = 0
+
+        chunk = []
+        position = self._replay_position
+        while position < len(self._replay_lines) and len(chunk) < chunk_size:
+            try:
+                chunk.extend(json.loads(self._replay_lines[position]))
+            except ValueError:
+                # A partially written line from a power loss. Skip it.
+                logger.debug(f"Skipping a damaged line in spool segment {self._segments[0]}")
+            position += 1
+
+        if chunk:
+            write(chunk)
+        self._replay_position = position
+
+        if position >= len(self._replay_lines):
+            os.remove(self._path(self._segments.pop(0)))
+            self._replay_lines = None
+
+        return len(chunk)